@@ -0,0 +1,39 @@
+"""How does rebuilding `stats all` scale with the number of islands?
+
+Each size gets a fresh database, and the reply is built from scratch the way the first
+`stats all` of a half-day is, with no solved models cached.
+
+Run with `python -m benchmarks.aggregate` from the repository root.
+"""
+import os
+import tempfile
+import time
+
+from stonkbot import batch, db, models
+from stonkbot.storage import open_backend
+from benchmarks.islands import make_islands
+
+SIZES = [10, 100, 1000, 10000]
+
+
+def main() -> None:
+    print(f"{'islands':>8}  {'total (s)':>10}  {'per island (ms)':>16}")
+    for size in SIZES:
+        with tempfile.TemporaryDirectory() as workdir:
+            store = open_backend(os.path.join(workdir, "turnips.sqlite"))
+            for i, island in enumerate(make_islands(size)):
+                store.put(str(i), island)
+            store.flush()
+            models._model_cache.clear()
+
+            start = time.perf_counter()
+            db.ForecastSnapshot().messages(store)
+            elapsed = time.perf_counter() - start
+            store.close()
+
+        print(f"{size:8d}  {elapsed:10.3f}  {elapsed / size * 1000:16.3f}")
+    batch.shutdown()
+
+
+if __name__ == "__main__":
+    main()
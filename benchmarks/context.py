@@ -0,0 +1,30 @@
+"""Just enough of a discord.py command context to call the bot's handlers directly."""
+from datetime import datetime
+from types import SimpleNamespace
+from typing import List, Optional
+
+
+class FakeMessage:
+    def __init__(self, author: SimpleNamespace, channel: SimpleNamespace, created_at: Optional[datetime] = None) -> None:
+        self.author = author
+        self.channel = channel
+        # discord.py hands out naive UTC timestamps
+        self.created_at = created_at or datetime.utcnow()
+        self.reactions: List[str] = []
+
+    async def add_reaction(self, reaction: str) -> None:
+        self.reactions.append(reaction)
+
+
+class FakeContext:
+    def __init__(self, user_id: int, guild_id: int = 1, channel_id: int = 1, command: str = "") -> None:
+        self.command = SimpleNamespace(qualified_name=command)
+        self.command_failed = False
+        self.author = SimpleNamespace(id=user_id, name=f"user{user_id}")
+        self.guild = SimpleNamespace(id=guild_id)
+        self.channel = SimpleNamespace(id=channel_id)
+        self.message = FakeMessage(self.author, self.channel)
+        self.sent: List[str] = []
+
+    async def send(self, content: str) -> None:
+        self.sent.append(content)
@@ -0,0 +1,56 @@
+"""Do the prediction engines agree, and how long does each take per island?
+
+Every engine describes the same generated islands, and anything that differs from the
+Counter engine is reported. Exits with an error if any engine disagrees.
+
+Run with `python -m benchmarks.engines [islands]` from the repository root.
+"""
+import sys
+import time
+
+from turnips.model import ModelEnum
+
+from stonkbot import engine, models
+from benchmarks.islands import make_islands
+
+ISLANDS = 1000
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else ISLANDS
+    solved = [models.solve(island.timeline) for island in make_islands(count)]
+    reference = engine.CounterEngine()
+    expected = [reference.describe(island) for island in solved]
+
+    mismatches = 0
+    print(f"{'engine':>8}  {'per island (ms)':>16}  {'mismatches':>10}")
+    for name, engine_class in engine.ENGINES.items():
+        prediction_engine = engine_class()
+        start = time.perf_counter()
+        described = [prediction_engine.describe(island) for island in solved]
+        elapsed = time.perf_counter() - start
+
+        wrong = 0
+        for island, (price_sets, patterns), (expected_prices, expected_patterns) in zip(solved, described, expected):
+            same = (
+                price_sets == expected_prices
+                and patterns == expected_patterns
+                and prediction_engine.price_sets(island) == expected_prices
+                and prediction_engine.pattern_counts(island) == expected_patterns
+                and all(
+                    prediction_engine.probabilities(patterns, previous)
+                    == reference.probabilities(expected_patterns, previous)
+                    for previous in ModelEnum
+                    if previous != ModelEnum.unknown
+                )
+            )
+            wrong += not same
+        mismatches += wrong
+        print(f"{name:>8}  {elapsed / count * 1000:16.3f}  {wrong:10d}")
+
+    if mismatches:
+        raise SystemExit(f"{mismatches} islands were described differently by the engines")
+
+
+if __name__ == "__main__":
+    main()
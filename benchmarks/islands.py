@@ -0,0 +1,48 @@
+"""Synthetic island generator shared by the benchmarks."""
+import random
+from datetime import datetime
+from typing import Iterator, Optional
+
+from dateutil import tz
+from turnips.meta import MetaModel
+from turnips.ttime import TimePeriod
+
+from stonkbot.models import WeekData
+
+TIMEZONES = [
+    "America/New_York",
+    "America/Los_Angeles",
+    "Europe/London",
+    "Europe/Berlin",
+    "Asia/Tokyo",
+    "Australia/Sydney",
+]
+
+
+def make_island(rng: random.Random, name: str, periods: Optional[int] = None) -> WeekData:
+    """Build an island whose prices follow a pattern the models can actually produce."""
+    tz_name = rng.choice(TIMEZONES)
+    base = rng.randint(90, 110)
+    if periods is None:
+        periods = rng.randint(1, 12)
+
+    island = WeekData(name=name, timeline={TimePeriod.Sunday_AM: base})
+    island.tz_name = tz_name
+    island.updated = datetime.now(tz=tz.gettz(tz_name))
+
+    models = MetaModel.blank(base)
+    for i in range(TimePeriod.Monday_AM.value, TimePeriod.Monday_AM.value + periods):
+        time = TimePeriod(i)
+        price_counts = models.histogram().get(time.name)
+        if not price_counts:
+            break
+        price = rng.choice(sorted(price_counts))
+        models.fix_price(time, price)
+        island.timeline[time] = price
+    return island
+
+
+def make_islands(count: int, seed: int = 0) -> Iterator[WeekData]:
+    rng = random.Random(seed)
+    for i in range(count):
+        yield make_island(rng, f"Island {i:05d}")
@@ -0,0 +1,126 @@
+"""Replay a week of turnip traffic through the bot's command handlers.
+
+Every island sets its timezone and name, then logs a week of prices that follow a real
+pattern, with `stats` requests mixed in. All islands send their commands for a period
+at once. Each storage backend and prediction engine gets a fresh database in turn, and
+throughput, latency percentiles and peak traced memory are reported for each. Memory
+used by batch solver processes is not traced.
+
+Run with `python -m benchmarks.load [islands]` from the repository root.
+"""
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from turnips.ttime import TimePeriod
+
+from stonkbot import batch, db, discord_bot, engine, models
+from stonkbot.aio import AsyncDB
+from stonkbot.archive import ARCHIVE_DIR, WeekArchive
+from benchmarks.context import FakeContext
+from benchmarks.islands import make_island
+
+ISLANDS = 1000
+STATS_CHANCE = 0.2
+STATS_TARGETS = [None, None, "all", "stonkbot", "records"]
+BACKENDS = {"shelve": "turnips.db", "sqlite": "turnips.sqlite"}
+
+# (label, handler name, user id, handler arguments)
+Command = Tuple[str, str, int, Tuple[Optional[str], ...]]
+
+
+def make_traffic(count: int, seed: int = 0) -> List[List[Command]]:
+    """Return the commands sent in each round: set up, then one round per period."""
+    rng = random.Random(seed)
+    rounds: List[List[Command]] = [[] for _ in range(len(TimePeriod) + 1)]
+    for i in range(count):
+        user_id = 100000 + i
+        island = make_island(rng, f"Island {i:05d}", periods=12)
+        rounds[0].append(("timezone", "timezone", user_id, (island.tz_name,)))
+        rounds[0].append(("rename", "rename", user_id, tuple(island.name.split())))
+        for time_period, price in island.timeline.items():
+            rounds[time_period.value + 1].append(("log", "log", user_id, (str(price), time_period.name)))
+            if rng.random() < STATS_CHANCE:
+                target = rng.choice(STATS_TARGETS)
+                rounds[time_period.value + 1].append((f"stats {target or 'me'}", "stats", user_id, (target,)))
+    for commands in rounds:
+        rng.shuffle(commands)
+    return rounds
+
+
+async def replay(rounds: List[List[Command]]) -> Dict[str, List[float]]:
+    latencies: Dict[str, List[float]] = defaultdict(list)
+
+    async def send(label: str, handler: str, user_id: int, args: Tuple[Optional[str], ...]) -> None:
+        if handler == "log":
+            args = (int(args[0]), args[1])
+        # Everyone gets a channel to themselves so the stats cooldown doesn't drop requests
+        ctx = FakeContext(user_id, channel_id=user_id)
+        start = time.perf_counter()
+        await discord_bot.before_command(ctx)
+        await getattr(discord_bot, handler).callback(ctx, *args)
+        latencies[label].append(time.perf_counter() - start)
+
+    for commands in rounds:
+        # Periods are twelve hours apart, long enough for every cooldown to run out
+        discord_bot._user_cooldown._cache.clear()
+        await asyncio.gather(*(send(*command) for command in commands))
+    return latencies
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[round(q * (len(ordered) - 1))]
+
+
+def run(backend: str, engine_name: str, rounds: List[List[Command]]) -> Tuple[float, int, Dict[str, List[float]]]:
+    """Replay the traffic against a fresh database, returning wall time, peak memory and latencies."""
+    with tempfile.TemporaryDirectory() as workdir:
+        engine.use(engine_name)
+        models._model_cache.clear()
+        db._archive = WeekArchive(os.path.join(workdir, ARCHIVE_DIR))
+        db.open_storage(os.path.join(workdir, BACKENDS[backend]))
+        discord_bot.store = AsyncDB()
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        latencies = asyncio.run(replay(rounds))
+        elapsed = time.perf_counter() - start
+        _current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        discord_bot.store.close()
+        batch.shutdown()
+    return elapsed, peak, latencies
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else ISLANDS
+    rounds = make_traffic(count)
+    total = sum(len(commands) for commands in rounds)
+    print(f"{count} islands, {total} commands")
+    print(f"{'backend':>8}  {'engine':>8}  {'time (s)':>9}  {'cmd/s':>8}  {'p50 (ms)':>9}  {'p99 (ms)':>9}  {'peak (MiB)':>10}")
+    for backend in BACKENDS:
+        for engine_name in engine.ENGINES:
+            elapsed, peak, latencies = run(backend, engine_name, rounds)
+            every = [latency for values in latencies.values() for latency in values]
+            print(
+                f"{backend:>8}  {engine_name:>8}  {elapsed:9.2f}  {total / elapsed:8.0f}  "
+                f"{percentile(every, 0.5) * 1000:9.2f}  {percentile(every, 0.99) * 1000:9.2f}  "
+                f"{peak / 2 ** 20:10.1f}"
+            )
+            for label, values in sorted(latencies.items()):
+                print(
+                    f"{label:>28}  {len(values):8d}  "
+                    f"{percentile(values, 0.5) * 1000:9.2f}  {percentile(values, 0.99) * 1000:9.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
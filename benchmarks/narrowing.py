@@ -0,0 +1,49 @@
+"""Cost of logging a Saturday price: narrowing the cached models vs. a full replay.
+
+Run with `python -m benchmarks.narrowing` from the repository root.
+"""
+import copy
+import random
+import time
+
+from turnips.ttime import TimePeriod
+
+from stonkbot import models
+from benchmarks.islands import make_island
+
+ROUNDS = 200
+
+
+def main() -> None:
+    rng = random.Random(0)
+    islands = []
+    while len(islands) < ROUNDS:
+        island = make_island(rng, f"Island {len(islands):03d}", periods=12)
+        saturday = island.timeline.pop(TimePeriod.Saturday_PM, None)
+        if saturday:
+            islands.append((island, saturday))
+
+    replay = 0.0
+    for island, price in islands:
+        island = copy.deepcopy(island)
+        island.set_price(price, TimePeriod.Saturday_PM)
+        models._model_cache.clear()
+        start = time.perf_counter()
+        island.models
+        replay += time.perf_counter() - start
+
+    narrow = 0.0
+    for island, price in islands:
+        island = copy.deepcopy(island)
+        island.models
+        start = time.perf_counter()
+        island.set_price(price, TimePeriod.Saturday_PM)
+        island.models
+        narrow += time.perf_counter() - start
+
+    print(f"full replay:  {replay / ROUNDS * 1000:.3f} ms per log")
+    print(f"narrowing:    {narrow / ROUNDS * 1000:.3f} ms per log")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""How long until the bot is ready, and how long does the first command take?
+
+Startup is timed in a fresh interpreter importing the bot the way `python -m stonkbot`
+does, then again loading the database layer up front as the bot used to. The first
+`stats all` against a database of synthetic islands is timed cold, and again after
+:meth:`AsyncDB.warm_up` has run.
+
+Run with `python -m benchmarks.startup [islands]` from the repository root.
+"""
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from stonkbot import batch, db, discord_bot, models
+from stonkbot.aio import AsyncDB
+from stonkbot.archive import ARCHIVE_DIR, WeekArchive
+from benchmarks.context import FakeContext
+from benchmarks.islands import make_islands
+
+ISLANDS = 1000
+GUILD = 1
+STARTUP = "import stonkbot.__main__"
+EAGER_STARTUP = STARTUP + "; import stonkbot.db"
+
+
+def time_startup(code: str) -> float:
+    timed = f"import time; start = time.perf_counter(); {code}; print(time.perf_counter() - start)"
+    output = subprocess.run([sys.executable, "-c", timed], check=True, capture_output=True, text=True)
+    return float(output.stdout)
+
+
+def populate(path: str, count: int) -> None:
+    store = db.open_storage(path)
+    for i, island in enumerate(make_islands(count)):
+        store.put(str(i), island)
+        store.add_member(GUILD, str(i))
+    db.close_storage()
+
+
+async def first_stats(path: str, warm: bool) -> float:
+    discord_bot.store = AsyncDB()
+    discord_bot.store.configure(path)
+    # Every island was added to the guild's index by populate()
+    discord_bot._indexed_guilds.add(GUILD)
+    if warm:
+        await discord_bot.store.warm_up([None, GUILD])
+    ctx = FakeContext(0, guild_id=GUILD)
+    start = time.perf_counter()
+    await discord_bot.stats.callback(ctx, "all")
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else ISLANDS
+    print(f"import, lazy:          {time_startup(STARTUP) * 1000:8.0f} ms")
+    print(f"import, eager:         {time_startup(EAGER_STARTUP) * 1000:8.0f} ms")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, "turnips.sqlite")
+        db._archive = WeekArchive(os.path.join(workdir, ARCHIVE_DIR))
+        populate(path, count)
+        for warm in (False, True):
+            models._model_cache.clear()
+            elapsed = asyncio.run(first_stats(path, warm))
+            discord_bot.store.close()
+            batch.shutdown()
+            label = "warmed up" if warm else "cold"
+            print(f"first stats all, {label + ':':10} {elapsed * 1000:8.0f} ms ({count} islands)")
+
+
+if __name__ == "__main__":
+    main()
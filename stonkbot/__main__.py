@@ -1,15 +1,33 @@
 import logging
 import os
 
-from stonkbot.discord_bot import bot
+# metrics comes before discord_bot, so startup is timed from here
+from stonkbot import lazy, metrics
+from stonkbot.discord_bot import bot, store
+
+# Loaded on first use, so logging in doesn't wait for the prediction stack
+batch = lazy.load("stonkbot.batch")
+storage = lazy.load("stonkbot.storage")
 
 
 def main():
     logger = logging.getLogger("stonkbot")
     logger.setLevel(logging.INFO)
-    handler = logging.FileHandler(filename="disco_bot.log", mode="w")
+    handler = logging.FileHandler(filename="disco_bot.log", mode="a")
     logger.addHandler(handler)
-    bot.run(os.environ.get("DISCORD_TOKEN"))
+    if "STONKBOT_METRICS_PORT" in os.environ:
+        metrics.serve(int(os.environ["STONKBOT_METRICS_PORT"]))
+    path = os.environ.get("STONKBOT_DB")
+    if os.environ.get("STONKBOT_SHARD_IDS") and not (path or "").endswith(storage.SQLITE_SUFFIXES):
+        # A shelf can only be open in one process at a time
+        raise SystemExit("Running a subset of shards needs a SQLite STONKBOT_DB")
+    # The database is opened and islands preloaded in the background after login
+    store.configure(path, os.environ.get("STONKBOT_ENGINE"))
+    try:
+        bot.run(os.environ.get("DISCORD_TOKEN"))
+    finally:
+        store.close()
+        batch.shutdown()
 
 
 if __name__ == "__main__":
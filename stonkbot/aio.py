@@ -0,0 +1,255 @@
+"""Asyncio front end for :mod:`stonkbot.db`.
+
+The db functions block on storage and on solving models, so calling them directly from a
+command would stall the event loop for every guild. Reads run concurrently on a thread
+pool, while writes are funnelled through a single queue and writer thread so they stay
+ordered. Reads and writes share a readers-writer lock, but the reads that solve models
+(`stats`, `stats all` and `stats stonkbot`) only hold it while copying islands out of
+storage, so a rebuild never holds up a `log`, or the reads queued behind it.
+The writer also flushes staged writes to disk once the oldest of them has waited
+:data:`~stonkbot.storage.FLUSH_INTERVAL` seconds, however busy it is.
+
+Nothing behind :mod:`stonkbot.db` is imported or opened until it is first needed, which
+is usually :meth:`AsyncDB.warm_up` running in the background once the bot has logged in.
+Lazy modules aren't safe to load from two threads at once, so the event loop only names
+db functions, and the worker threads look them up once :meth:`AsyncDB._open` has loaded
+everything.
+"""
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from discord.ext import commands
+
+from stonkbot import lazy, metrics
+from stonkbot.utils import ReadWriteLock
+
+db = lazy.load("stonkbot.db")
+engine = lazy.load("stonkbot.engine")
+models = lazy.load("stonkbot.models")
+storage = lazy.load("stonkbot.storage")
+
+ROLLOVER_CHECK_INTERVAL = 3600
+logger = logging.getLogger("stonkbot")
+
+WriteJob = Tuple[str, Tuple[Any, ...], "asyncio.Future[Any]"]
+
+
+class AsyncDB:
+    def __init__(self, readers: int = 4, solvers: int = 2, flush_interval: Optional[float] = None) -> None:
+        self.flush_interval = flush_interval
+        # Storage path and engine name to open on first use
+        self._config: Optional[Tuple[Optional[str], Optional[str]]] = None
+        self._opened = False
+        self._open_lock = threading.Lock()
+        self._lock = ReadWriteLock()
+        self._read_pool = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="stonkbot-read")
+        # Rebuilding `stats all` and `stats stonkbot` can take a while, so they get their own
+        # threads and everything else never queues behind them
+        self._solve_pool = ThreadPoolExecutor(max_workers=solvers, thread_name_prefix="stonkbot-solve")
+        self._write_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stonkbot-write")
+        self._writes: Optional["asyncio.Queue[WriteJob]"] = None
+        self._writer: Optional["asyncio.Task[None]"] = None
+        self._members: Set[Tuple[int, str]] = set()
+        self._in_flight: Dict[Tuple[str, Tuple[Any, ...]], "asyncio.Future[Any]"] = {}
+
+    # Read-only functions
+    async def meta_stats(self, guild: Optional[int] = None) -> str:
+        return await self._shared("meta_stats", guild, aggregate=True)
+
+    async def user_stats(self, key: str) -> str:
+        return await self._read("user_stats", key, takes_lock=True)
+
+    async def all_stats(self, guild: Optional[int] = None) -> List[str]:
+        return await self._shared("all_stats", guild, aggregate=True)
+
+    async def records(self) -> str:
+        return await self._shared("records")
+
+    async def history(self, key: str) -> str:
+        return await self._read("history", key)
+
+    async def pattern_stats(self) -> str:
+        return await self._shared("pattern_stats")
+
+    # Modifying functions
+    async def add_member(self, guild: int, key: str) -> None:
+        # Most commands come from people already known to be in the guild
+        if (guild, key) not in self._members:
+            await self._write("add_member", guild, key)
+            self._members.add((guild, key))
+
+    async def add_members(self, guild: int, keys: Iterable[str]) -> int:
+        # Members without an island aren't indexed, so they aren't remembered here either
+        return await self._write("add_members", guild, list(keys))
+
+    async def rename(self, key: str, island_name: str) -> None:
+        await self._write("rename", key, island_name)
+
+    async def log(self, ctx: commands.Context, price: int, time: Optional[str] = None) -> str:
+        return await self._write("log", ctx, price, time)
+
+    async def set_timezone(self, key: str, zone_name: str) -> bool:
+        return await self._write("set_timezone", key, zone_name)
+
+    async def rollover_weeks(self, full: bool = False) -> int:
+        return await self._write("rollover_weeks", full)
+
+    async def run_rollovers(self) -> None:
+        """Roll islands over to the new week as each timezone's week ends."""
+        archived = await self.rollover_weeks(full=True)
+        logger.info("Archived %d finished weeks at startup", archived)
+        while True:
+            boundary = await self._read("next_rollover")
+            delay = (boundary - datetime.now(tz=timezone.utc)).total_seconds()
+            # Wake up at least hourly in case someone moves to an earlier timezone
+            await asyncio.sleep(min(max(delay, 0) + 1, ROLLOVER_CHECK_INTERVAL))
+            if datetime.now(tz=timezone.utc) >= boundary:
+                archived = await self.rollover_weeks()
+                logger.info("Week rolled over at %s, archived %d finished weeks", boundary.isoformat(), archived)
+
+    def configure(self, path: Optional[str] = None, engine_name: Optional[str] = None) -> None:
+        """Choose the database and prediction engine, without loading either yet.
+
+        Either one left as None gets the default.
+        """
+        self._config = (path, engine_name)
+
+    async def warm_up(self, guilds: Iterable[Optional[int]] = (None,)) -> None:
+        """Load everything the first commands would otherwise wait for.
+
+        Each step is its own read, so commands that arrive meanwhile aren't held up.
+        """
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            await loop.run_in_executor(self._read_pool, self._open)
+            islands = await self._read("preload_islands")
+            for guild in guilds:
+                await self._shared("all_stats", guild, aggregate=True)
+                await self._shared("meta_stats", guild, aggregate=True)
+        except Exception:
+            logger.exception("Warming up failed")
+            return
+        elapsed = time.perf_counter() - start
+        metrics.warm_seconds.set(elapsed)
+        logger.info("Warmed up %d active islands in %.2fs", islands, elapsed)
+
+    def close(self) -> None:
+        if self._writer:
+            self._writer.cancel()
+        self._read_pool.shutdown(wait=True)
+        self._solve_pool.shutdown(wait=True)
+        self._write_pool.shutdown(wait=True)
+        if self._opened or self._config is None:
+            with self._lock.write():
+                db.close_storage()
+
+    # Plumbing
+    async def _read(self, name: str, *args: Any, takes_lock: bool = False, aggregate: bool = False) -> Any:
+        """Run the db function `name` on a thread pool.
+
+        If `takes_lock` is set, it is passed the read lock to take for itself rather than
+        being run under it. An `aggregate` runs on the pool kept for rebuilding them.
+        """
+        loop = asyncio.get_running_loop()
+        pool = self._solve_pool if aggregate else self._read_pool
+        read = self._unlocked_read if takes_lock else self._locked_read
+        return await loop.run_in_executor(pool, partial(read, name, *args))
+
+    async def _shared(self, name: str, *args: Any, aggregate: bool = False) -> Any:
+        """Read, but let concurrent callers asking the same question share one answer.
+
+        Aggregates take the read lock for themselves, see :func:`stonkbot.db.all_stats`.
+        """
+        key = (name, args)
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._read(name, *args, takes_lock=aggregate, aggregate=aggregate))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # One caller giving up shouldn't cancel the query for everyone else
+        return await asyncio.shield(future)
+
+    async def _write(self, name: str, *args: Any) -> Any:
+        if self._writes is None:
+            self._writes = asyncio.Queue()
+            self._writer = asyncio.create_task(self._write_loop(self._writes))
+        future = asyncio.get_running_loop().create_future()
+        await self._writes.put((name, args, future))
+        return await future
+
+    async def _write_loop(self, queue: "asyncio.Queue[WriteJob]") -> None:
+        loop = asyncio.get_running_loop()
+        # When the oldest write that isn't on disk yet is due to be flushed
+        flush_at: Optional[float] = None
+        while True:
+            timeout = None if flush_at is None else max(flush_at - loop.time(), 0)
+            try:
+                name, args, future = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                flush_at = None
+                try:
+                    await loop.run_in_executor(self._write_pool, partial(self._locked_write, "flush_storage"))
+                except Exception:
+                    # Storage keeps whatever it couldn't write, so try again later
+                    logger.exception("Flushing storage failed")
+                    flush_at = self._flush_deadline()
+                continue
+
+            try:
+                result = await loop.run_in_executor(
+                    self._write_pool, partial(self._locked_write, name, *args)
+                )
+            except Exception as exc:
+                logger.exception("Write %s failed", name)
+                if not future.done():
+                    future.set_exception(exc)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                queue.task_done()
+            if flush_at is None and self._opened:
+                flush_at = self._flush_deadline()
+
+    def _flush_deadline(self) -> float:
+        # Only called once storage is open, so reading its settings can't import anything
+        return asyncio.get_running_loop().time() + (self.flush_interval or storage.FLUSH_INTERVAL)
+
+    def _open(self) -> None:
+        """Import everything behind :mod:`stonkbot.db`, and open it if we were configured.
+
+        Threads wait here while another one imports, so none sees a half-loaded module.
+        """
+        if self._opened:
+            return
+        with self._open_lock:
+            if not self._opened:
+                if self._config is None:
+                    # Whoever made us opened the database, so just finish importing
+                    db.open_storage
+                else:
+                    path, engine_name = self._config
+                    engine.use(engine_name or engine.CounterEngine.name)
+                    db.open_storage(path or storage.SHELVE_FILE)
+                self._opened = True
+
+    def _locked_read(self, name: str, *args: Any) -> Any:
+        self._open()
+        with self._lock.read():
+            return getattr(db, name)(*args)
+
+    def _unlocked_read(self, name: str, *args: Any) -> Any:
+        self._open()
+        return getattr(db, name)(*args, reading=self._lock.read)
+
+    def _locked_write(self, name: str, *args: Any) -> Any:
+        self._open()
+        with self._lock.write():
+            return getattr(db, name)(*args)
@@ -0,0 +1,158 @@
+"""Append-only record of finished weeks.
+
+The archive is stored by column: each field has its own file of fixed-width values in
+the archive directory, and island keys are numbered in a separate index file. Queries
+memory-map only the columns they need and stream through them, so no island has to be
+loaded to answer them.
+"""
+import mmap
+import os
+from array import array
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from datetime import date
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # no file locks on Windows, so only one process may write
+    fcntl = None
+
+from turnips.model import ModelEnum
+from turnips.ttime import TimePeriod
+
+from stonkbot.models import FinishedWeek
+
+ARCHIVE_DIR = "weeks"
+KEYS_FILE = "islands.txt"
+LOCK_FILE = ".lock"
+# Column name: (array typecode, values per week)
+COLUMNS = {
+    "island": ("I", 1),
+    "week": ("i", 1),
+    "prices": ("H", len(TimePeriod)),
+    "pattern": ("b", 1),
+}
+
+
+class WeekArchive:
+    def __init__(self, path: str = ARCHIVE_DIR) -> None:
+        self.path = path
+        self._keys: Dict[str, int] = {}
+        # Size of the key index when it was read, to notice other processes adding to it
+        self._keys_size = -1
+
+    def append(self, weeks: Iterable[Tuple[str, FinishedWeek]]) -> int:
+        """Add finished weeks to the end of the archive, returning how many were added."""
+        weeks = list(weeks)
+        if not weeks:
+            return 0
+
+        os.makedirs(self.path, exist_ok=True)
+        with self._locked():
+            return self._append(weeks)
+
+    def _append(self, weeks: List[Tuple[str, FinishedWeek]]) -> int:
+        columns = {name: array(typecode) for name, (typecode, _) in COLUMNS.items()}
+        keys = self._index()
+        new_keys = []
+        for key, week in weeks:
+            if key not in keys:
+                keys[key] = len(keys)
+                new_keys.append(key)
+            columns["island"].append(keys[key])
+            columns["week"].append(week.week.toordinal())
+            columns["prices"].extend(week.prices)
+            columns["pattern"].append(week.pattern.value)
+
+        if new_keys:
+            with open(os.path.join(self.path, KEYS_FILE), "a") as key_file:
+                key_file.writelines(f"{key}\n" for key in new_keys)
+            self._keys_size = os.path.getsize(os.path.join(self.path, KEYS_FILE))
+        for name, values in columns.items():
+            with open(self._column_path(name), "ab") as column:
+                values.tofile(column)
+        return len(weeks)
+
+    def history(self, key: str) -> Iterator[FinishedWeek]:
+        """Yield every archived week for an island, oldest first."""
+        index = self._index().get(key)
+        if index is None:
+            return
+
+        with self._columns("island", "week", "prices", "pattern") as (islands, weeks, prices, patterns):
+            width = COLUMNS["prices"][1]
+            for row, island in enumerate(islands):
+                if island == index:
+                    yield FinishedWeek(
+                        week=date.fromordinal(weeks[row]),
+                        prices=tuple(prices[row * width:(row + 1) * width]),
+                        pattern=ModelEnum(patterns[row]),
+                    )
+
+    def pattern_counts(self, key: Optional[str] = None) -> Counter:
+        """Count how often each pattern was seen, for one island or for all of them."""
+        counts: Counter = Counter()
+        if key is None:
+            with self._columns("pattern") as (patterns,):
+                counts.update(patterns)
+        else:
+            index = self._index().get(key)
+            if index is not None:
+                with self._columns("island", "pattern") as (islands, patterns):
+                    counts.update(pattern for island, pattern in zip(islands, patterns) if island == index)
+        return Counter({ModelEnum(value): count for value, count in counts.items()})
+
+    def _column_path(self, name: str) -> str:
+        return os.path.join(self.path, f"{name}.col")
+
+    def _index(self) -> Dict[str, int]:
+        path = os.path.join(self.path, KEYS_FILE)
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return self._keys
+        if size != self._keys_size:
+            with open(path) as key_file:
+                self._keys = {line.rstrip("\n"): index for index, line in enumerate(key_file)}
+            self._keys_size = size
+        return self._keys
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        """Hold the archive's lock file, so processes sharing it append one at a time."""
+        with open(os.path.join(self.path, LOCK_FILE), "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _rows(self) -> int:
+        # An append cut short leaves some columns longer than others; ignore the extra
+        rows = []
+        for name, (typecode, width) in COLUMNS.items():
+            try:
+                size = os.path.getsize(self._column_path(name))
+            except FileNotFoundError:
+                return 0
+            rows.append(size // (array(typecode).itemsize * width))
+        return min(rows)
+
+    @contextmanager
+    def _columns(self, *names: str) -> Iterator[List[memoryview]]:
+        """Map columns into memory, trimmed to the number of complete weeks."""
+        rows = self._rows()
+        views = []
+        with ExitStack() as stack:
+            for name in names:
+                typecode, width = COLUMNS[name]
+                if not rows:
+                    views.append(memoryview(b"").cast(typecode))
+                    continue
+                column = stack.enter_context(open(self._column_path(name), "rb"))
+                mapped = stack.enter_context(mmap.mmap(column.fileno(), 0, access=mmap.ACCESS_READ))
+                raw = memoryview(mapped)
+                stack.callback(raw.release)
+                view = raw[:rows * width * array(typecode).itemsize].cast(typecode)
+                stack.callback(view.release)
+                views.append(view)
+            yield views
@@ -0,0 +1,84 @@
+"""Solve many islands at once on a pool of worker processes.
+
+Model solving is CPU bound, so the aggregate commands hand whole batches of islands to
+worker processes. Islands travel as compact payloads (first-week flag and 14 prices)
+rather than pickled :class:`WeekData`, and come back as per-period price sets and a
+pattern, which is all the aggregates need.
+"""
+import math
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from turnips.model import ModelEnum
+from turnips.multi import MultiModel
+from turnips.ttime import TimePeriod
+
+from stonkbot import engine, models
+
+# Smaller batches aren't worth the trip to another process
+BATCH_THRESHOLD = 64
+CHUNKS_PER_WORKER = 4
+
+Payload = Tuple[bool, Tuple[int, ...]]
+Solution = Tuple[Dict[str, List[int]], ModelEnum]
+
+_pool: Optional[ProcessPoolExecutor] = None
+# Aggregates for different guilds can be rebuilt at the same time
+_pool_lock = threading.Lock()
+_workers = os.cpu_count() or 1
+
+
+def solve_islands(payloads: Sequence[Payload]) -> List[Solution]:
+    """Return each island's possible prices by period and its pattern, in order."""
+    if len(payloads) < BATCH_THRESHOLD:
+        return [_solve(item) for item in payloads]
+
+    pool = _get_pool()
+    size = math.ceil(len(payloads) / (_workers * CHUNKS_PER_WORKER))
+    chunks = [payloads[i:i + size] for i in range(0, len(payloads), size)]
+    solutions: List[Solution] = []
+    for chunk_solutions in pool.map(_solve_chunk, chunks):
+        solutions.extend(chunk_solutions)
+    return solutions
+
+
+def solution(solved: MultiModel) -> Solution:
+    """Boil solved models down to what the aggregates need."""
+    price_sets, patterns = engine.current().describe(solved)
+    pattern = ModelEnum[patterns[0][0]] if len(patterns) == 1 else ModelEnum.unknown
+    return price_sets, pattern
+
+
+def shutdown() -> None:
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True)
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # The bot runs threads of its own, so don't fork
+            _pool = ProcessPoolExecutor(
+                max_workers=_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=engine.use,
+                initargs=(engine.current().name,),
+            )
+        return _pool
+
+
+def _solve_chunk(chunk: Sequence[Payload]) -> List[Solution]:
+    return [_solve(item) for item in chunk]
+
+
+def _solve(item: Payload) -> Solution:
+    initial_week, prices = item
+    timeline = {TimePeriod(i): price for i, price in enumerate(prices) if price}
+    return solution(models.solve(timeline, initial_week))
@@ -1,27 +1,49 @@
 import collections
+import heapq
+import itertools
 import logging
-import shelve
+import math
+import threading
+from contextlib import nullcontext
 from dataclasses import dataclass, field
-from datetime import date, timezone
-from operator import attrgetter
-from typing import Counter, Dict, List, Optional
+from datetime import date, datetime, timedelta, timezone
+from typing import (
+    Callable, ContextManager, Counter, Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set,
+    Tuple, TypeVar,
+)
 
 from discord.ext import commands
 from turnips.model import ModelEnum
 from turnips.multi import RangeSet
 from turnips.ttime import TimePeriod
 
-from stonkbot import utils
-from stonkbot.models import WeekData
-
-SHELVE_FILE = "turnips.db"
+from stonkbot import batch, utils
+from stonkbot.archive import ARCHIVE_DIR, WeekArchive
+from stonkbot.models import FinishedWeek, Fingerprint, WeekData, cached_solve, zone_clock
+from stonkbot.storage import SHELVE_FILE, Storage, open_backend, week_floor
+
+# Prices are packed into unsigned shorts, and Nook's Cranny never gets past three digits
+MAX_PRICE = 999
+# Islands solved together when `stats all` is rebuilt from scratch
+STREAM_BATCH = 1024
+# How many finished weeks to show in an island's history
+HISTORY_WEEKS = 10
+# Most islands named for any one period in `stats all`
+TOP_ISLANDS = 5
 logger = logging.getLogger("stonkbot")
+_storage: Optional[Storage] = None
+T = TypeVar("T")
+# Takes the storage read lock. Functions passed one only hold it while copying from storage.
+Reading = Callable[[], ContextManager[None]]
+_archive = WeekArchive(ARCHIVE_DIR)
+# Every timezone an island is in, so we know when weeks end
+_zones: Set[str] = set()
 
 
 # Helper dataclasses & functions
 @dataclass
 class StatBundle:
-    price_range: RangeSet
+    price_range: List[int]
     name: str
     confidence: str
 
@@ -29,41 +51,369 @@ class StatBundle:
 @dataclass
 class PriceBundle:
     prices: RangeSet = field(default_factory=RangeSet)
-    _top_prices: List[StatBundle] = field(default_factory=list)
+    # Min-heap of the best TOP_ISLANDS islands as (top price, -arrival, stats), so the
+    # lowest price goes first, and of equal prices the one added last
+    _top_prices: List[Tuple[int, int, StatBundle]] = field(default_factory=list)
+    _added: int = 0
 
     def add_price(self, stats: StatBundle):
-        self._top_prices.append(stats)
+        entry = (max(stats.price_range), -self._added, stats)
+        self._added += 1
+        if len(self._top_prices) < TOP_ISLANDS:
+            heapq.heappush(self._top_prices, entry)
+        elif entry > self._top_prices[0]:
+            heapq.heapreplace(self._top_prices, entry)
 
     @property
     def top_prices(self) -> List[StatBundle]:
-        return list(sorted(self._top_prices, key=lambda x: max(x.price_range), reverse=True))
+        return [stats for _price, _arrival, stats in sorted(self._top_prices, reverse=True)]
 
 
-def _islands_to_stats(islands: List[WeekData]) -> Dict[str, PriceBundle]:
-    stats: Dict[str, PriceBundle] = {}
-    for island in islands:
-        for time, price_counts in island.models.histogram().items():
-            if not island.is_current_week:
-                continue
+class IslandView(NamedTuple):
+    """The parts of an island the aggregates need, copied out of storage.
 
-            current_stat = stats.get(time, PriceBundle())
+    Views are taken under the read lock, so solving them doesn't hold up writes.
+    """
+    name: str
+    fingerprint: Fingerprint
+    has_week_data: bool
+    has_current_period: bool
+    period_ends: float
+
+    @classmethod
+    def of(cls, island: WeekData) -> "IslandView":
+        return cls(
+            name=island.name,
+            fingerprint=island.fingerprint,
+            has_week_data=island.has_week_data,
+            has_current_period=island.has_current_period,
+            period_ends=island.period_ends.timestamp(),
+        )
+
+    @property
+    def payload(self) -> batch.Payload:
+        prices, initial_week, _previous_week = self.fingerprint
+        timeline = [0] * len(TimePeriod)
+        for i, price in prices:
+            timeline[i] = price
+        return initial_week, tuple(timeline)
+
+
+def _solve_views(views: List[IslandView]) -> List[batch.Solution]:
+    # Solving in this process competes with command handling for the GIL, so only a
+    # handful of islands are solved here, most likely just logged and so already cached
+    if len(views) >= batch.BATCH_THRESHOLD:
+        return batch.solve_islands([view.payload for view in views])
+    return [batch.solution(cached_solve(view.fingerprint)) for view in views]
+
+
+def _island_stats(view: IslandView, solution: batch.Solution) -> Dict[str, StatBundle]:
+    """Work out one island's contribution to each period's forecast."""
+    price_sets, pattern = solution
+    default_type = "possibility"
+    if pattern != ModelEnum.unknown:
+        default_type = "range"
+    fixed_times = {TimePeriod(i).name for i, _price in view.fingerprint[0]}
+
+    return {
+        time: StatBundle(
+            price_range=prices,
+            name=view.name,
+            confidence="fixed" if time in fixed_times else default_type,
+        )
+        for time, prices in price_sets.items()
+    }
+
+
+def _merge_stats(contributions: Iterable[Dict[str, StatBundle]]) -> Dict[str, PriceBundle]:
+    stats: Dict[str, PriceBundle] = {}
+    for island_stats in contributions:
+        for time, stat in island_stats.items():
+            current_stat = stats.setdefault(time, PriceBundle())
 
-            for price in price_counts.keys():
+            for price in stat.price_range:
                 current_stat.prices.add(price)
 
-            price_type = "possibility"
-            if island.current_pattern != ModelEnum.unknown:
-                price_type = "range"
-            if TimePeriod[time] in island.timeline:
-                price_type = "fixed"
+            current_stat.add_price(stat)
+
+    return stats
+
+
+class ForecastSnapshot:
+    """The last `stats all` reply, along with each island's contribution to it.
+
+    Writes mark an island stale, and only stale islands are solved again on the next read.
+    Everything is rebuilt when the turnip half-day rolls over, since that changes both
+    which islands count and what the reply looks like. Each guild has its own snapshot
+    covering its members' islands; guild None covers every island.
+
+    Islands are copied out of storage a batch at a time under the read lock, and each batch
+    is solved after it is released. Writes that land meanwhile leave their island stale
+    for the next read.
+    """
+
+    def __init__(self, guild: Optional[int] = None) -> None:
+        self.guild = guild
+        # Guards the fields below, and is only held briefly so writes can always invalidate
+        self._lock = threading.Lock()
+        # Held while bringing the snapshot up to date, so only one reader does it
+        self._updating = threading.Lock()
+        self._period: Optional[Tuple[date, bool]] = None
+        self._contributions: Optional[Dict[str, Dict[str, StatBundle]]] = None
+        self._stale: Set[str] = set()
+        self._messages: Optional[List[str]] = None
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            self._stale.add(key)
+            self._messages = None
+
+    def messages(self, store: Storage, reading: Reading = nullcontext) -> List[str]:
+        with self._updating:
+            with self._lock:
+                now = datetime.now()
+                period = (now.date(), now.hour >= 12)
+                if period != self._period:
+                    self._period = period
+                    self._contributions = None
+                rebuild = self._contributions is None
+                if not rebuild and not self._stale and self._messages is not None:
+                    return self._messages
+                stale, self._stale = self._stale, set()
 
-            current_stat.add_price(
-                StatBundle(price_range=price_counts, name=island.name, confidence=price_type)
+            try:
+                contributions = self._solve(store, reading, None if rebuild else stale)
+            except BaseException:
+                with self._lock:
+                    self._stale |= stale
+                raise
+
+            with self._lock:
+                if rebuild:
+                    self._contributions = {}
+                assert self._contributions is not None
+                for key, contribution in contributions.items():
+                    if contribution is None:
+                        self._contributions.pop(key, None)
+                    else:
+                        self._contributions[key] = contribution
+                merged = list(self._contributions.values())
+                up_to_date = not self._stale
+
+            messages = list(utils.paginate(_render_forecast(_merge_stats(merged))))
+            if up_to_date:
+                with self._lock:
+                    if not self._stale:
+                        self._messages = messages
+            return messages
+
+    def _solve(
+        self, store: Storage, reading: Reading, stale: Optional[Set[str]]
+    ) -> Dict[str, Optional[Dict[str, StatBundle]]]:
+        """Work out contributions for every island, or just the `stale` ones.
+
+        Islands that no longer count towards the snapshot map to None.
+        """
+        contributions: Dict[str, Optional[Dict[str, StatBundle]]] = {}
+        for views in self._views(store, reading, stale):
+            solvable = []
+            for key, view in views:
+                if view is None:
+                    contributions[key] = None
+                else:
+                    solvable.append((key, view))
+            solutions = _solve_views([view for _, view in solvable])
+            for (key, view), solution in zip(solvable, solutions):
+                contributions[key] = _island_stats(view, solution)
+        return contributions
+
+    def _views(
+        self, store: Storage, reading: Reading, stale: Optional[Set[str]]
+    ) -> Iterator[List[Tuple[str, Optional[IslandView]]]]:
+        """Copy islands out of storage STREAM_BATCH at a time.
+
+        The read lock is only held while a batch is copied, and the next batch isn't read
+        until the caller has finished with the last one.
+        """
+        if stale is not None:
+            for keys in _batches(stale, STREAM_BATCH):
+                with reading():
+                    views: List[Tuple[str, Optional[IslandView]]] = []
+                    for key in keys:
+                        island = store.get(key)
+                        counts = island and island.has_week_data and _counts_towards(store, self.guild, key)
+                        views.append((key, IslandView.of(island) if counts else None))
+                yield views
+            return
+
+        with reading():
+            members = _members(store, self.guild)
+        batches = _batches(store.items(since=week_floor(), keys=members), STREAM_BATCH)
+        while True:
+            with reading():
+                chunk = next(batches, None)
+                if chunk is None:
+                    return
+                # Only report islands with non-Sunday data
+                views = [(key, IslandView.of(island)) for key, island in chunk if island.has_week_data]
+            yield views
+
+
+@dataclass
+class IslandStatus:
+    has_week_data: bool
+    has_current_period: bool
+    pattern: ModelEnum
+    # Timestamp after which the flags above may no longer hold
+    expires: float
+
+
+class MetaCounters:
+    """Running totals behind `stats stonkbot`.
+
+    Writes mark an island stale. An island with data this week is also re-checked when
+    its half-day period ends, since that can change whether it has a price for right
+    now, or has data for this week at all. Reads only touch islands that are stale or
+    expired. Like :class:`ForecastSnapshot`, there is one per guild.
+    """
+
+    def __init__(self, guild: Optional[int] = None) -> None:
+        self.guild = guild
+        # Held only briefly, as for ForecastSnapshot
+        self._lock = threading.Lock()
+        self._updating = threading.Lock()
+        self._statuses: Optional[Dict[str, IslandStatus]] = None
+        self._expiry: List[Tuple[float, str]] = []
+        self._stale: Set[str] = set()
+        self._this_week = 0
+        self._current = 0
+        self._patterns: Counter[ModelEnum] = collections.Counter()
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            self._stale.add(key)
+
+    def counts(
+        self, store: Storage, reading: Reading = nullcontext
+    ) -> Tuple[int, int, int, Counter[ModelEnum]]:
+        """Return total islands, islands with data this week, islands with a current price,
+        and patterns for islands with data this week."""
+        with self._updating:
+            with self._lock:
+                rebuild = self._statuses is None
+                if not rebuild:
+                    assert self._statuses is not None
+                    now = datetime.now(tz=timezone.utc).timestamp()
+                    while self._expiry and self._expiry[0][0] <= now:
+                        expires, key = heapq.heappop(self._expiry)
+                        if self._statuses[key].expires == expires:
+                            self._stale.add(key)
+                stale, self._stale = self._stale, set()
+
+            try:
+                # Copy the islands under the read lock, and solve them after releasing it
+                with reading():
+                    if rebuild:
+                        views = {
+                            key: IslandView.of(island)
+                            for key, island in store.items(keys=_members(store, self.guild))
+                        }
+                    else:
+                        views = {}
+                        for key in stale:
+                            island = store.get(key)
+                            if island and _counts_towards(store, self.guild, key):
+                                views[key] = IslandView.of(island)
+                viable = [(key, view) for key, view in views.items() if view.has_week_data]
+                solutions = _solve_views([view for _, view in viable])
+            except BaseException:
+                with self._lock:
+                    self._stale |= stale
+                raise
+            patterns = {key: pattern for (key, _), (_, pattern) in zip(viable, solutions)}
+
+            with self._lock:
+                if self._statuses is None:
+                    self._statuses = {}
+                for key, view in views.items():
+                    self._set(key, view, patterns.get(key, ModelEnum.unknown))
+                counted = collections.Counter({
+                    pattern: count for pattern, count in self._patterns.items() if count > 0
+                })
+                return len(self._statuses), self._this_week, self._current, counted
+
+    def _set(self, key: str, view: IslandView, pattern: ModelEnum) -> None:
+        assert self._statuses is not None
+        old = self._statuses.get(key)
+        if old:
+            self._count(old, -1)
+
+        status = IslandStatus(False, False, ModelEnum.unknown, math.inf)
+        if view.has_week_data:
+            status = IslandStatus(
+                has_week_data=True,
+                has_current_period=view.has_current_period,
+                pattern=pattern,
+                expires=view.period_ends,
             )
+            heapq.heappush(self._expiry, (status.expires, key))
+        self._statuses[key] = status
+        self._count(status, 1)
 
-            stats[time] = current_stat
+    def _count(self, status: IslandStatus, sign: int) -> None:
+        if status.has_week_data:
+            self._this_week += sign
+            self._patterns[status.pattern] += sign
+            if status.has_current_period:
+                self._current += sign
 
-    return stats
+
+# Aggregates for each guild, created on first use
+_forecasts: Dict[Optional[int], ForecastSnapshot] = {}
+_metas: Dict[Optional[int], MetaCounters] = {}
+_aggregates_lock = threading.Lock()
+
+
+def _forecast(guild: Optional[int]) -> ForecastSnapshot:
+    with _aggregates_lock:
+        if guild not in _forecasts:
+            _forecasts[guild] = ForecastSnapshot(guild)
+        return _forecasts[guild]
+
+
+def _meta(guild: Optional[int]) -> MetaCounters:
+    with _aggregates_lock:
+        if guild not in _metas:
+            _metas[guild] = MetaCounters(guild)
+        return _metas[guild]
+
+
+def _invalidate(key: str) -> None:
+    """Mark an island stale in every aggregate it counts towards."""
+    guilds = {None, *open_storage().guilds_of(key)}
+    with _aggregates_lock:
+        aggregates = [
+            aggregate
+            for guild in guilds
+            for aggregate in (_forecasts.get(guild), _metas.get(guild))
+            if aggregate is not None
+        ]
+    for aggregate in aggregates:
+        aggregate.invalidate(key)
+
+
+def _reset_aggregates() -> None:
+    with _aggregates_lock:
+        _forecasts.clear()
+        _metas.clear()
+
+
+def _members(store: Storage, guild: Optional[int]) -> Optional[Set[str]]:
+    return None if guild is None else store.members(guild)
+
+
+def _counts_towards(store: Storage, guild: Optional[int], key: str) -> bool:
+    return guild is None or store.is_member(guild, key)
 
 
 def _top_islands(top_prices: List[StatBundle], length: int = 3) -> str:
@@ -75,19 +425,63 @@ def _top_islands(top_prices: List[StatBundle], length: int = 3) -> str:
     return ' '.join(prices)
 
 
+def _render_forecast(stats: Dict[str, PriceBundle]) -> Iterator[str]:
+    # Periods nobody has a prediction for yet are shown empty
+    stats = collections.defaultdict(PriceBundle, stats)
+    start = date.today().isoweekday() % 7 * 2
+    if start != 0:
+        yield f"Island forecasts for {TimePeriod(start).name[:-3]}:"
+        yield "```"
+        yield f"AM: {_top_islands(stats[TimePeriod(start).name].top_prices, TOP_ISLANDS)}"
+        yield f"PM: {_top_islands(stats[TimePeriod(start + 1).name].top_prices, TOP_ISLANDS)}"
+        yield "```"
+
+    start += 2
+
+    # Each period's prices are formatted once, for both the column width and its row
+    ranges = {time: str(stat_bundle.prices) for time, stat_bundle in stats.items()}
+    longest_price_set = max([15, *(len(prices) for prices in ranges.values())])
+    yield "Predictions for the rest of the week:"
+    yield "```"
+    yield f"Time          {'Possible Prices'.ljust(longest_price_set)}  Top Three Islands"
+    for i in range(start, 14):
+        time = TimePeriod(i).name
+        prices = ranges.get(time, "").ljust(longest_price_set)
+        yield f"{time:12}  {prices}  {_top_islands(stats[time].top_prices)}"
+    yield "```"
+    yield "* number is exactly as reported on island"
+    yield "† number is possible on island, but pattern has not been confirmed"
+
+
+# Storage lifecycle
+def open_storage(path: str = SHELVE_FILE) -> Storage:
+    global _storage
+    if _storage is None:
+        _storage = open_backend(path)
+    elif _storage.sync():
+        # Another process changed the database, so none of the aggregates can be trusted
+        _reset_aggregates()
+    return _storage
+
+
+def flush_storage() -> None:
+    if _storage is not None:
+        _storage.flush()
+
+
+def close_storage() -> None:
+    global _storage
+    if _storage is not None:
+        _storage.close()
+        _storage = None
+    _reset_aggregates()
+
+
 # Read-only functions
-def meta_stats() -> str:
-    current = 0
-    patterns: Counter[ModelEnum] = collections.Counter()
-    with shelve.open(SHELVE_FILE, flag="r") as shelf:
-        viable_islands = [island for island in shelf.values() if island.has_week_data]
-
-        total = len(shelf)
-        this_week = len(viable_islands)
-        for island in viable_islands:
-            if island.has_current_period:
-                current += 1
-            patterns[island.current_pattern] += 1
+def meta_stats(guild: Optional[int] = None, reading: Reading = nullcontext) -> str:
+    with reading():
+        store, meta = open_storage(), _meta(guild)
+    total, this_week, current, patterns = meta.counts(store, reading)
 
     pattern_str = ", ".join(
         f"{_plural_has(count)} pattern {model.name}"
@@ -100,66 +494,85 @@ def meta_stats() -> str:
     ])
 
 
-def user_stats(key: str) -> str:
-    with shelve.open(SHELVE_FILE, flag="r") as shelf:
-        island_data = shelf[key]
+def user_stats(key: str, reading: Reading = nullcontext) -> str:
+    with reading():
+        island_data = open_storage().get(key)
+        # Solve a private copy, so writes needn't wait for it
+        island_data = island_data and WeekData.unpack(island_data.pack())
+    if island_data is None:
+        raise KeyError(key)
     return "\n".join(island_data.summary())
 
 
-def all_stats() -> str:
-    islands = []
-    with shelve.open(SHELVE_FILE, flag="r") as shelf:
-        for week_data in shelf.values():
-            # Only report islands with non-Sunday data
-            if week_data.has_week_data:
-                islands.append(week_data)
+def all_stats(guild: Optional[int] = None, reading: Reading = nullcontext) -> List[str]:
+    with reading():
+        store, forecast = open_storage(), _forecast(guild)
+    return forecast.messages(store, reading)
 
-    stats = _islands_to_stats(islands)
 
-    msg = []
-    start = date.today().isoweekday() % 7 * 2
-    if start != 0:
-        msg.extend([f"Island forecasts for {TimePeriod(start).name[:-3]}:", "```"])
-        msg.append(f"AM: {_top_islands(stats[TimePeriod(start).name].top_prices, 5)}")
-        msg.append(f"PM: {_top_islands(stats[TimePeriod(start + 1).name].top_prices, 5)}")
-        msg.append("```")
+def records() -> str:
+    return "\n".join(
+        f"{name} saw {record.price} on {record.date.isoformat()} {'AM' if record.is_am else 'PM'}"
+        for name, record in open_storage().records(300)
+    )
 
-    start += 2
 
-    longest_price_set = max(15, *(len(str(stat.prices)) for stat in stats.values()))
-    msg.append("Predictions for the rest of the week:")
-    msg.extend(["```", f"Time          {'Possible Prices'.ljust(longest_price_set)}  Top Three Islands"])
-    for i in range(start, 14):
-        time = TimePeriod(i).name
-        stat_bundle = stats[time]
-        prices = str(stat_bundle.prices).ljust(longest_price_set)
-        msg.append(f"{time:12}  {prices}  {_top_islands(stat_bundle.top_prices)}")
-    msg.append("```")
-    msg.append("* number is exactly as reported on island")
-    msg.append("† number is possible on island, but pattern has not been confirmed")
+def history(key: str) -> str:
+    weeks: Deque[FinishedWeek] = collections.deque(maxlen=HISTORY_WEEKS)
+    weeks.extend(_archive.history(key))
+    if not weeks:
+        return "I don't have any finished weeks for your island yet."
 
-    return "\n".join(msg)
+    lines = ["Your most recent finished weeks:"]
+    for week in weeks:
+        buy = week.prices[0] or week.prices[1]
+        sells = [price for price in week.prices[2:] if price]
+        best = f"best price {max(sells)}" if sells else "no sale prices"
+        lines.append(f"Week of {week.week.isoformat()}: pattern {week.pattern.name}, bought at {buy or '?'}, {best}")
+    patterns = _archive.pattern_counts(key)
+    lines.append("Overall: " + _pattern_frequencies(patterns))
+    return "\n".join(lines)
 
 
-def records() -> str:
-    with shelve.open(SHELVE_FILE, flag="r") as shelf:
-        known_records = [island for island in shelf.values() if island.record.price >= 300]
+def pattern_stats() -> str:
+    patterns = _archive.pattern_counts()
+    if not patterns:
+        return "No weeks have finished yet."
+    return f"Over {sum(patterns.values())} finished weeks: " + _pattern_frequencies(patterns)
 
-    return "\n".join(
-        f"{island.name} saw {island.record.price} on {island.record.date.isoformat()} {'AM' if island.record.is_am else 'PM'}"
-        for island in sorted(known_records, key=attrgetter("record.price"), reverse=True)
-    )
+
+def preload_islands() -> int:
+    return open_storage().preload(since=week_floor())
 
 
 # Modifying functions
+def add_member(guild: int, key: str) -> None:
+    if open_storage().add_member(guild, key):
+        _invalidate(key)
+
+
+def add_members(guild: int, keys: Iterable[str]) -> int:
+    """Index every member of a guild who has an island, returning how many were new."""
+    store = open_storage()
+    added = 0
+    for key in store.existing(keys):
+        if store.add_member(guild, key):
+            _invalidate(key)
+            added += 1
+    return added
+
+
 def rename(key: str, island_name: str) -> None:
-    with shelve.open(SHELVE_FILE) as shelf:
-        data = shelf.get(key)
-        if not data:
-            data = WeekData(name=island_name, timeline={})
-        else:
-            data.name = island_name
-        shelf[key] = data
+    store = open_storage()
+    data = store.get(key)
+    if not data:
+        # Renamed rather than created with the name, so the name is written even if
+        # another process creates the island first
+        data = _new_island(f"Island {key[-3:]}")
+    data.name = island_name
+    store.rename_record(key, island_name)
+    store.put(key, data)
+    _invalidate(key)
 
 
 def log(ctx: commands.Context, price: int, time: Optional[str] = None) -> str:
@@ -168,46 +581,114 @@ def log(ctx: commands.Context, price: int, time: Optional[str] = None) -> str:
             time = TimePeriod.normalize(time)
         except KeyError:
             return f"{time} is not a valid time period. Try 'Monday_PM' or 'Friday_AM'."
+    if not 0 <= price <= MAX_PRICE:
+        return f"{price} is not a valid turnip price."
 
     key = str(ctx.author.id)
-    with shelve.open(SHELVE_FILE) as shelf:
-        data = shelf.get(key)
-        if not data:
-            default_name = f"Island {key[-3:]}"
-            data = WeekData(name=default_name, timeline={})
-        if not time:
-            if not data.timezone:
-                return (
-                    "Cannot infer time period without knowing your time zone. "
-                    "Try `!turnip timezone [time zone]` (e.g., America/New_York) and try again, "
-                    f"or specify time period with `!turnip log {price} [Monday_AM]` or similar."
-                )
-            # Get message created time (which is UTC) and convert to user's local time
-            timestamp = ctx.message.created_at.replace(tzinfo=timezone.utc).astimezone(data.timezone)
-            logger.info("Computed local message time as %s", timestamp.isoformat())
-            try:
-                time = utils.datetime_to_timeperiod(timestamp)
-                logger.info("Turnip time period is %s", time)
-            except ValueError as exc:
-                return str(exc).format(price=price)
-        data.set_price(price, time)
-        shelf[key] = data
+    store = open_storage()
+    data = store.get(key)
+    if not data:
+        data = _new_island(f"Island {key[-3:]}")
+    if not time:
+        if not data.timezone:
+            return (
+                "Cannot infer time period without knowing your time zone. "
+                "Try `!turnip timezone [time zone]` (e.g., America/New_York) and try again, "
+                f"or specify time period with `!turnip log {price} [Monday_AM]` or similar."
+            )
+        # Get message created time (which is UTC) and convert to user's local time
+        timestamp = ctx.message.created_at.replace(tzinfo=timezone.utc).astimezone(data.timezone)
+        logger.info("Computed local message time as %s", timestamp.isoformat())
+        try:
+            time = utils.datetime_to_timeperiod(timestamp)
+            logger.info("Turnip time period is %s", time)
+        except ValueError as exc:
+            return str(exc).format(price=price)
+    if not data.is_current_week:
+        finished = data.rollover()
+        if store.claim_weeks([(key, data)]):
+            if finished:
+                _archive.append([(key, finished)])
+        else:
+            # Another bot process got to the new week first, and may have logged in it
+            data = store.get(key) or data
+    if data.set_price(price, time):
+        store.update_record(key, data.name, data.record)
+    store.put(key, data)
+    _invalidate(key)
 
     return ""
 
 
 def set_timezone(key: str, zone_name: str) -> bool:
     success = False
-    with shelve.open(SHELVE_FILE) as shelf:
-        data = shelf.get(key)
-        if not data:
-            default_name = f"Island {key[-3:]}"
-            data = WeekData(name=default_name, timeline={})
-        success = data.set_tz(zone_name)
-        shelf[key] = data
+    store = open_storage()
+    data = store.get(key)
+    if not data:
+        data = _new_island(f"Island {key[-3:]}")
+    success = data.set_tz(zone_name)
+    if success:
+        _zones.add(zone_name)
+    store.put(key, data)
+    _invalidate(key)
     return success
 
 
+def rollover_weeks(full: bool = False) -> int:
+    """Move every island whose week has ended on to the new week, in one batched write.
+
+    Finished weeks are archived. Islands are rolled over as each timezone's week ends,
+    so only those updated in the last fortnight can need it, unless `full` is set.
+    Returns the number of weeks archived.
+    """
+    store = open_storage()
+    since = None if full else week_floor() - timedelta(days=7)
+    rolled: List[Tuple[str, WeekData, Optional[FinishedWeek]]] = []
+    for key, island in list(store.items(since=since)):
+        _zones.add(island.tz_name)
+        if not island.timeline or island.is_current_week:
+            continue
+        rolled.append((key, island, island.rollover()))
+
+    # Islands another bot process already rolled over were archived by that process
+    claimed = store.claim_weeks((key, island) for key, island, _week in rolled)
+    finished: List[Tuple[str, FinishedWeek]] = []
+    for key, island, week in rolled:
+        if key in claimed:
+            if week:
+                finished.append((key, week))
+            store.put(key, island)
+        _invalidate(key)
+
+    store.flush()
+    return _archive.append(finished)
+
+
+def next_rollover() -> datetime:
+    """When the next week starts in any timezone we know about."""
+    return min(zone_clock(zone).sunday + timedelta(days=7) for zone in _zones or {""})
+
+
 # Private utils
+def _new_island(name: str) -> WeekData:
+    return WeekData(name=name, timeline={})
+
+
+def _pattern_frequencies(patterns: Counter) -> str:
+    total = sum(patterns.values())
+    return ", ".join(
+        f"{model.name} {count / total:.0%}" for model, count in patterns.most_common()
+    )
+
+
+def _batches(items: Iterable[T], size: int) -> Iterator[List[T]]:
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 def _plural_has(count: int) -> str:
     return f"{count} {'has' if count == 1 else 'have'}"
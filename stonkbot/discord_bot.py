@@ -1,23 +1,123 @@
+import asyncio
 import logging
+import os
 import random
-from typing import Optional
+import time
+from typing import List, Optional, Set
 
 import discord
 from discord.ext import commands
 
-from stonkbot import db
+from stonkbot import metrics
+from stonkbot.aio import AsyncDB
 
 logger = logging.getLogger("stonkbot")
 
 
-bot = commands.Bot(command_prefix="!turnip ")
+def _make_bot() -> commands.Bot:
+    """Build the bot, sharded if STONKBOT_SHARD_COUNT is set.
+
+    STONKBOT_SHARD_IDS (e.g. "0,1") picks which of those shards this process runs, so
+    several processes can split the load. They then have to share a SQLite database.
+    """
+    prefix = "!turnip "
+    if "STONKBOT_SHARD_COUNT" not in os.environ:
+        return commands.Bot(command_prefix=prefix)
+
+    shard_ids = None
+    if os.environ.get("STONKBOT_SHARD_IDS"):
+        shard_ids = [int(shard) for shard in os.environ["STONKBOT_SHARD_IDS"].split(",")]
+    return commands.AutoShardedBot(
+        command_prefix=prefix,
+        shard_count=int(os.environ["STONKBOT_SHARD_COUNT"]),
+        shard_ids=shard_ids,
+    )
+
+
+bot = _make_bot()
+store = AsyncDB()
+_rollovers: Optional["asyncio.Task[None]"] = None
+_warm_up: Optional["asyncio.Task[None]"] = None
+# Guilds whose every member with an island is in the index
+_indexed_guilds: Set[int] = set()
+
+# Stats requests allowed per user, and per channel for the answers everyone shares
+STATS_COOLDOWN = 30.0
+_user_cooldown = commands.CooldownMapping.from_cooldown(3, STATS_COOLDOWN, commands.BucketType.user)
+_channel_cooldown = commands.CooldownMapping.from_cooldown(4, STATS_COOLDOWN, commands.BucketType.channel)
+SHARED_STATS = {"stonkbot", "all", "records", "patterns"}
+
+
+@bot.event
+async def on_ready() -> None:
+    global _rollovers, _warm_up
+    if _warm_up is None:
+        ready = time.perf_counter() - metrics.STARTED
+        metrics.ready_seconds.set(ready)
+        logger.info("Logged in %.2fs after starting", ready)
+        _warm_up = asyncio.create_task(_start(list(bot.guilds)))
+
+    # on_ready fires again after every reconnect. With shards split over several
+    # processes, only the one running shard 0 rolls weeks over.
+    shard_ids = getattr(bot, "shard_ids", None)
+    if _rollovers is None and (shard_ids is None or 0 in shard_ids):
+        _rollovers = asyncio.create_task(store.run_rollovers())
+
+
+@bot.event
+async def on_guild_join(guild: discord.Guild) -> None:
+    await _index_members(guild)
+
+
+async def _start(guilds: List[discord.Guild]) -> None:
+    # Members are indexed as they use commands, which misses everyone who hasn't since
+    # the index was added, so fill it in before the per-guild stats are warmed up
+    for guild in guilds:
+        await _index_members(guild)
+    await store.warm_up([None, *_indexed_guilds])
+
+
+async def _index_members(guild: discord.Guild) -> None:
+    try:
+        added = await store.add_members(guild.id, (str(member.id) for member in guild.members))
+    except Exception:
+        logger.exception("Indexing members of guild %s failed", guild.id)
+        return
+    logger.info("Indexed %d more islands in guild %s", added, guild.id)
+    if guild.chunked:
+        _indexed_guilds.add(guild.id)
+    else:
+        # Without the members intent only some members are known
+        logger.warning(
+            "Only %d of %s members of guild %s are known, so its stats cover every island",
+            len(guild.members), guild.member_count, guild.id,
+        )
+
+
+@bot.before_invoke
+async def before_command(ctx: commands.Context) -> None:
+    ctx.started_at = time.perf_counter()
+    if ctx.guild is not None:
+        await store.add_member(ctx.guild.id, str(ctx.author.id))
+
+
+@bot.after_invoke
+async def record_latency(ctx: commands.Context) -> None:
+    command = ctx.command.qualified_name
+    latency = time.perf_counter() - ctx.started_at
+    metrics.command_seconds.observe(latency, command=command)
+    if metrics.first_command_seconds.value is None:
+        metrics.first_command_seconds.set(latency)
+        logger.info("First command since starting (%s) took %.0fms", command, latency * 1000)
+    if ctx.command_failed:
+        metrics.command_errors.inc(command=command)
 
 
 @bot.command(description="Log turnip prices", usage="<price> <time slot>")
 async def log(ctx: commands.Context, price: int, time: Optional[str] = None) -> None:
     logger.info("%s logged %s for %s", ctx.author.name, price, time)
 
-    error = db.log(ctx, price, time)
+    error = await store.log(ctx, price, time)
     if error:
         await ctx.send(error)
         return
@@ -52,7 +152,7 @@ async def rename(ctx: commands.Context, *new_name: str) -> None:
     name = " ".join(new_name)
     logger.info("%s said their island was named %s", ctx.author.name, name)
 
-    db.rename(str(ctx.author.id), name)
+    await store.rename(str(ctx.author.id), name)
     await react(ctx.message)
 
 
@@ -64,14 +164,32 @@ async def source(ctx: commands.Context) -> None:
 @bot.command()
 async def stats(ctx: commands.Context, target: Optional[str] = None) -> None:
     logger.info("%s asked for stats", ctx.author.name)
+    limited = _user_cooldown.update_rate_limit(ctx.message)
+    if not limited and target in SHARED_STATS:
+        limited = _channel_cooldown.update_rate_limit(ctx.message)
+    if limited:
+        logger.info("Stats for %s on cooldown for %.0fs", ctx.author.name, limited)
+        await react(ctx.message, "⏳")
+        return
+
     if target is None:
-        msg = db.user_stats(str(ctx.author.id))
+        msg = await store.user_stats(str(ctx.author.id))
     elif target == "stonkbot":
-        msg = db.meta_stats()
+        msg = await store.meta_stats(_guild_id(ctx))
     elif target == "all":
-        msg = db.all_stats()
+        for chunk in await store.all_stats(_guild_id(ctx)):
+            await ctx.send(chunk)
+        return
     elif target == "records":
-        msg = db.records()
+        msg = await store.records()
+    elif target == "history":
+        msg = await store.history(str(ctx.author.id))
+    elif target == "patterns":
+        msg = await store.pattern_stats()
+    elif target == "metrics":
+        if not await bot.is_owner(ctx.author):
+            return
+        msg = metrics.summary()
     else:
         logger.warning("Invalid target %s", target)
         return
@@ -82,13 +200,20 @@ async def stats(ctx: commands.Context, target: Optional[str] = None) -> None:
 @bot.command()
 async def timezone(ctx: commands.Context, zone_name: str) -> None:
     logger.info("%s set their timezone to %s", ctx.author.name, zone_name)
-    if not db.set_timezone(str(ctx.author.id), zone_name):
+    if not await store.set_timezone(str(ctx.author.id), zone_name):
         await ctx.send(f"No timezone named {zone_name} was found.")
         return
 
     await react(ctx.message, "⌚")
 
 
+def _guild_id(ctx: commands.Context) -> Optional[int]:
+    # Direct messages see every island, as do guilds until their members are indexed
+    if ctx.guild is not None and ctx.guild.id in _indexed_guilds:
+        return ctx.guild.id
+    return None
+
+
 async def react(message: discord.Message, reaction: str = "👀") -> None:
     try:
         await message.add_reaction(reaction)
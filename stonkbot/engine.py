@@ -0,0 +1,152 @@
+"""Ways of turning a set of surviving models into the numbers we report.
+
+:class:`CounterEngine` is the original approach, counting models and prices one at a
+time. :class:`NumpyEngine` packs the models into a models × periods matrix of price
+bounds and works everything out in bulk; it needs numpy, and gives identical output.
+"""
+import importlib.util
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from turnips.model import ModelEnum
+from turnips.multi import MultiModel
+from turnips.ttime import TimePeriod
+
+from stonkbot import lazy
+
+# numpy is optional, and slow to import, so it is only loaded once the engine is used
+np = lazy.load("numpy") if importlib.util.find_spec("numpy") else None
+
+# Chance of each pattern this week, indexed by last week's pattern
+WEIGHTS = [
+    [20, 30, 15, 35],
+    [50, 5, 20, 25],
+    [25, 45, 5, 25],
+    [45, 25, 15, 15],
+]
+# How many models make up each pattern
+EXPECTED_PATTERNS = [56, 7, 1, 8]
+PERIODS = len(TimePeriod)
+
+PatternCounts = List[Tuple[str, int]]
+PriceSets = Dict[str, List[int]]
+
+
+class CounterEngine:
+    name = "counter"
+
+    def price_sets(self, models: MultiModel) -> PriceSets:
+        """Return the possible prices for each period, in ascending order."""
+        return {time: sorted(price_counts) for time, price_counts in models.histogram().items()}
+
+    def pattern_counts(self, models: MultiModel) -> PatternCounts:
+        """Return how many models belong to each pattern, most common first."""
+        return Counter(model.model_name for model in models.models).most_common()
+
+    def describe(self, models: MultiModel) -> Tuple[PriceSets, PatternCounts]:
+        """Return both :meth:`price_sets` and :meth:`pattern_counts`."""
+        return self.price_sets(models), self.pattern_counts(models)
+
+    def probabilities(self, patterns: PatternCounts, previous_week: ModelEnum) -> List[float]:
+        """Weigh pattern counts by how likely each pattern is to follow last week's."""
+        expected_weights = WEIGHTS[previous_week.value]
+        probabilities = [0.0, 0.0, 0.0, 0.0]
+        for pattern_name, count in patterns:
+            model_value = ModelEnum[pattern_name].value
+            probabilities[model_value] = count / EXPECTED_PATTERNS[model_value] * expected_weights[model_value]
+        return probabilities
+
+
+class ModelMatrix:
+    """Price bounds for each surviving model, one row per model and one column per period.
+
+    Periods a model has no price for are left at -1.
+    """
+
+    def __init__(self, models: MultiModel) -> None:
+        model_list = list(models.models)
+        self.lows = np.full((len(model_list), PERIODS), -1, dtype=np.int32)
+        self.highs = np.full((len(model_list), PERIODS), -1, dtype=np.int32)
+        self.patterns = np.empty(len(model_list), dtype=np.int8)
+        self.names = {}
+        for row, model in enumerate(model_list):
+            self.patterns[row] = model.model_type.value
+            self.names[model.model_type.value] = model.model_name
+            for time, pricecast in model.timeline.items():
+                self.lows[row, time.value] = pricecast.price.lower
+                self.highs[row, time.value] = pricecast.price.upper
+
+    def __len__(self) -> int:
+        return len(self.patterns)
+
+
+class NumpyEngine(CounterEngine):
+    name = "numpy"
+
+    def __init__(self) -> None:
+        # Finish the deferred import now: lazy modules aren't safe to load from
+        # several worker threads at once.
+        np.ndarray
+
+    def price_sets(self, models: MultiModel) -> PriceSets:
+        return self._price_sets(ModelMatrix(models))
+
+    def pattern_counts(self, models: MultiModel) -> PatternCounts:
+        return self._pattern_counts(ModelMatrix(models))
+
+    def describe(self, models: MultiModel) -> Tuple[PriceSets, PatternCounts]:
+        # Filling the matrix is a Python loop over every model, so only do it once
+        matrix = ModelMatrix(models)
+        return self._price_sets(matrix), self._pattern_counts(matrix)
+
+    def _price_sets(self, matrix: ModelMatrix) -> PriceSets:
+        if not len(matrix):
+            return {}
+
+        # Mark where each model's range starts and ends, then a running sum over prices
+        # gives how many models allow each price in each period.
+        rows, periods = np.nonzero(matrix.lows >= 0)
+        coverage = np.zeros((PERIODS, int(matrix.highs.max()) + 2), dtype=np.int32)
+        np.add.at(coverage, (periods, matrix.lows[rows, periods]), 1)
+        np.add.at(coverage, (periods, matrix.highs[rows, periods] + 1), -1)
+        possible = np.cumsum(coverage, axis=1) > 0
+
+        return {
+            TimePeriod(period).name: np.flatnonzero(possible[period]).tolist()
+            for period in np.unique(periods).tolist()
+        }
+
+    def _pattern_counts(self, matrix: ModelMatrix) -> PatternCounts:
+        if not len(matrix):
+            return []
+
+        patterns, first_seen, counts = np.unique(matrix.patterns, return_index=True, return_counts=True)
+        # Same order as Counter.most_common: by count, then by first appearance
+        order = np.lexsort((first_seen, -counts))
+        return [(matrix.names[int(patterns[i])], int(counts[i])) for i in order]
+
+    def probabilities(self, patterns: PatternCounts, previous_week: ModelEnum) -> List[float]:
+        counts = np.zeros(len(EXPECTED_PATTERNS))
+        for pattern_name, count in patterns:
+            counts[ModelEnum[pattern_name].value] = count
+        probabilities = counts / np.array(EXPECTED_PATTERNS) * np.array(WEIGHTS[previous_week.value])
+        return probabilities.tolist()
+
+
+ENGINES = {CounterEngine.name: CounterEngine}
+if np is not None:
+    ENGINES[NumpyEngine.name] = NumpyEngine
+
+_engine: CounterEngine = CounterEngine()
+
+
+def use(name: str) -> None:
+    """Switch the engine used for predictions."""
+    global _engine
+    if name not in ENGINES:
+        raise ValueError(f"Unknown or unavailable prediction engine {name!r}")
+    _engine = ENGINES[name]()
+
+
+def current() -> CounterEngine:
+    return _engine
@@ -0,0 +1,24 @@
+"""Deferred imports, so the bot can log in before the prediction stack is loaded."""
+import importlib.util
+import sys
+from types import ModuleType
+
+
+def load(name: str) -> ModuleType:
+    """Return a module that is only actually imported when one of its attributes is used."""
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None or spec.loader is None:
+        raise ImportError(f"No module named {name!r}", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    parent, _, child = name.rpartition(".")
+    if parent:
+        # A normal import binds submodules on their package; later imports expect it
+        setattr(sys.modules[parent], child, module)
+    return module
@@ -0,0 +1,60 @@
+"""Sorted index of the best sale prices seen on any island."""
+from bisect import bisect_left, insort
+from dataclasses import replace
+from typing import Dict, Iterable, List, Tuple
+
+from stonkbot.models import Record
+
+LEADERBOARD_SIZE = 50
+
+
+class Leaderboard:
+    """Top :data:`LEADERBOARD_SIZE` island records, kept sorted as they change.
+
+    Records only ever go up, so an island that falls off the bottom can never have a
+    better claim to a place than the one that pushed it off.
+    """
+
+    def __init__(self, size: int = LEADERBOARD_SIZE) -> None:
+        self.size = size
+        self._order: List[Tuple[int, str]] = []
+        self._entries: Dict[str, Tuple[str, Record]] = {}
+
+    def update(self, key: str, name: str, record: Record) -> bool:
+        """Place an island's record, returning True if the board changed."""
+        if key in self._entries:
+            self._remove(key)
+        elif len(self._order) >= self.size and record.price <= -self._order[-1][0]:
+            return False
+
+        insort(self._order, (-record.price, key))
+        self._entries[key] = (name, replace(record))
+        if len(self._order) > self.size:
+            _, dropped = self._order.pop()
+            del self._entries[dropped]
+        return True
+
+    def rename(self, key: str, name: str) -> bool:
+        if key not in self._entries:
+            return False
+        self._entries[key] = (name, self._entries[key][1])
+        return True
+
+    def top(self, min_price: int = 0) -> List[Tuple[str, Record]]:
+        """Return (island name, record) pairs at or above `min_price`, best first."""
+        cutoff = bisect_left(self._order, (-min_price + 1, ""))
+        return [self._entries[key] for _, key in self._order[:cutoff]]
+
+    def dump(self) -> List[Tuple[str, str, dict]]:
+        return [(key, self._entries[key][0], self._entries[key][1].dump()) for _, key in self._order]
+
+    @classmethod
+    def load(cls, data: Iterable[Tuple[str, str, dict]], size: int = LEADERBOARD_SIZE) -> "Leaderboard":
+        board = cls(size)
+        for key, name, record in data:
+            board.update(key, name, Record.load(record))
+        return board
+
+    def _remove(self, key: str) -> None:
+        _, record = self._entries.pop(key)
+        del self._order[bisect_left(self._order, (-record.price, key))]
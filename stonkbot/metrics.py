@@ -0,0 +1,204 @@
+"""Counters and latency histograms, served in the Prometheus text format.
+
+Metrics are kept in process and are cheap enough to update from any thread. Set
+``STONKBOT_METRICS_PORT`` to expose them at ``http://127.0.0.1:<port>/metrics``;
+``!turnip stats metrics`` shows a summary to the bot's owner.
+"""
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+# Upper bounds in seconds, from a cached read to a slow full scan
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+logger = logging.getLogger("stonkbot")
+# This module is the first thing the bot imports, so startup is timed from here
+STARTED = time.perf_counter()
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels: Labels, extra: str = "") -> str:
+    parts = [f'{name}="{value}"' for name, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, description: str) -> None:
+        self.name = name
+        self.description = description
+        self._lock = threading.Lock()
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def values(self) -> Dict[Labels, float]:
+        with self._lock:
+            return dict(self._values)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.values().items()):
+            lines.append(f"{self.name}{_format_labels(labels)} {value:g}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, description: str) -> None:
+        self.name = name
+        self.description = description
+        self.value: Optional[float] = None
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge"]
+        if self.value is not None:
+            lines.append(f"{self.name} {self.value:g}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, buckets: Tuple[float, ...] = BUCKETS) -> None:
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # Per label set: count in each bucket (the last one is +Inf), then the sum
+        self._values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _labels(labels)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def values(self) -> Dict[Labels, Tuple[List[int], float]]:
+        with self._lock:
+            return {key: (list(counts), total[0]) for key, (counts, total) in self._values.items()}
+
+    def quantile(self, q: float, counts: List[int]) -> Optional[float]:
+        """Estimate a quantile as the upper bound of the bucket it falls in."""
+        rank = q * sum(counts)
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return None
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in sorted(self.values().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                bucket_labels = _format_labels(labels, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total:g}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {cumulative}")
+        return lines
+
+
+command_seconds = Histogram("stonkbot_command_seconds", "Time taken to handle each command")
+command_errors = Counter("stonkbot_command_errors_total", "Commands that raised an error")
+storage_seconds = Histogram("stonkbot_storage_seconds", "Time spent opening, reading and writing storage")
+solve_seconds = Histogram("stonkbot_model_solve_seconds", "Time spent solving an island's models from scratch")
+narrows = Counter("stonkbot_model_narrows_total", "Copies of cached models narrowed by a new price instead of solved again")
+cache_requests = Counter("stonkbot_cache_requests_total", "Cache lookups by cache and result")
+ready_seconds = Gauge("stonkbot_ready_seconds", "Time from starting up to being logged in")
+warm_seconds = Gauge("stonkbot_warm_seconds", "Time taken to pre-warm models and islands after login")
+first_command_seconds = Gauge("stonkbot_first_command_seconds", "Latency of the first command after startup")
+
+METRICS = [
+    command_seconds, command_errors, storage_seconds, solve_seconds, narrows, cache_requests,
+    ready_seconds, warm_seconds, first_command_seconds,
+]
+
+
+def render() -> str:
+    return "\n".join(line for metric in METRICS for line in metric.render()) + "\n"
+
+
+def summary() -> str:
+    """A short human readable digest of the metrics."""
+    lines = [
+        f"{gauge.description}: {gauge.value * 1000:.0f}ms"
+        for gauge in (ready_seconds, warm_seconds, first_command_seconds)
+        if gauge.value is not None
+    ]
+    for prefix, histogram in (("!turnip", command_seconds), ("storage", storage_seconds)):
+        for labels, (counts, total) in sorted(histogram.values().items()):
+            count = sum(counts)
+            name = " ".join([prefix, *(value for _label, value in labels)])
+            lines.append(
+                f"{name}: {count} calls, mean {total / count * 1000:.1f}ms, "
+                f"p50 ≤{histogram.quantile(0.5, counts) * 1000:g}ms, "
+                f"p99 ≤{histogram.quantile(0.99, counts) * 1000:g}ms"
+            )
+    solves = solve_seconds.values().get((), ([0], 0.0))
+    lines.append(
+        f"{sum(solves[0])} model solves taking {solves[1]:.2f}s, "
+        f"{narrows.values().get((), 0):g} narrowed from a cached copy"
+    )
+
+    lookups: Dict[str, Dict[str, float]] = {}
+    for labels, value in cache_requests.values().items():
+        label_dict = dict(labels)
+        lookups.setdefault(label_dict["cache"], {})[label_dict["result"]] = value
+    for cache, results in sorted(lookups.items()):
+        total = sum(results.values())
+        lines.append(f"{cache} cache: {results.get('hit', 0) / total:.0%} hits of {total:g} lookups")
+    return "\n".join(lines)
+
+
+def serve(port: int, host: str = "127.0.0.1") -> "ThreadingHTTPServer":
+    """Serve /metrics from a background thread."""
+    # Only worth importing if metrics are actually served
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: object) -> None:
+            # Scrapes would drown out the bot's own log
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="stonkbot-metrics", daemon=True).start()
+    logger.info("Serving metrics on http://%s:%d/metrics", host, port)
+    return server
@@ -1,8 +1,15 @@
 from __future__ import annotations
-from collections import Counter
+import copy
+import logging
+import struct
+import threading
+from array import array
+from collections import Counter, OrderedDict
+from collections.abc import MutableMapping
 from dataclasses import dataclass
-from datetime import date, datetime, timedelta, tzinfo
-from typing import Dict, Iterable, Optional
+from datetime import date, datetime, timedelta, timezone, tzinfo
+from functools import lru_cache
+from typing import Dict, FrozenSet, Iterable, Iterator, Mapping, NamedTuple, Optional, Set, Tuple
 
 from dateutil import tz
 from turnips.ttime import TimePeriod
@@ -10,9 +17,106 @@ from turnips.model import ModelEnum
 from turnips.meta import MetaModel
 from turnips.multi import RangeSet, MultiModel, BumpModels
 
+from stonkbot import engine, metrics
+
+# Solved models are shared between every island with the same timeline, so the
+# MultiModels handed out here must be treated as read-only.
+MODEL_CACHE_SIZE = 1024
+logger = logging.getLogger("stonkbot")
+Fingerprint = Tuple[Tuple[Tuple[int, int], ...], bool, ModelEnum]
+_model_cache: OrderedDict[Fingerprint, MultiModel] = OrderedDict()
+_model_cache_lock = threading.Lock()
+
+
+def _cache_models(key: Fingerprint, models: MultiModel) -> None:
+    with _model_cache_lock:
+        _model_cache[key] = models
+        if len(_model_cache) > MODEL_CACHE_SIZE:
+            _model_cache.popitem(last=False)
+
+
+def solve(timeline: Dict[TimePeriod, int], initial_week: bool = False) -> MultiModel:
+    """Narrow the blank models down to those matching every price in a timeline."""
+    with metrics.solve_seconds.time():
+        if initial_week:
+            models = BumpModels()
+        else:
+            models = MetaModel.blank(timeline.get(TimePeriod.Sunday_AM))
+        for time, price in timeline.items():
+            if price is None:
+                continue
+            if time.value < TimePeriod.Monday_AM.value:
+                continue
+            models.fix_price(time, price)
+    return models
+
+
+def cached_solve(key: Fingerprint) -> MultiModel:
+    """Return the solved models for a fingerprint, solving and caching them on a miss."""
+    with _model_cache_lock:
+        models = _model_cache.get(key)
+        if models is not None:
+            _model_cache.move_to_end(key)
+    if models is not None:
+        metrics.cache_requests.inc(cache="models", result="hit")
+        return models
+
+    metrics.cache_requests.inc(cache="models", result="miss")
+    prices, initial_week, _previous_week = key
+    models = solve({TimePeriod(i): price for i, price in prices}, initial_week)
+    _cache_models(key, models)
+    return models
+
+
+@lru_cache(maxsize=1024)
+def get_tz(zone_name: str) -> Optional[tzinfo]:
+    return tz.gettz(zone_name)
+
+
+@dataclass(frozen=True)
+class ZoneClock:
+    """Where one timezone is in the turnip week, valid until the current period ends."""
+    sunday: datetime
+    last_sunday: datetime
+    period: int
+    period_ends: datetime
+    expires: float
+
+
+_clocks: Dict[str, ZoneClock] = {}
+
+
+def zone_clock(zone_name: str) -> ZoneClock:
+    """Return the week boundaries and current period for a timezone.
+
+    Every island in a zone shares the same answer, so it is worked out once per period.
+    """
+    clock = _clocks.get(zone_name)
+    if clock is not None and datetime.now(tz=timezone.utc).timestamp() < clock.expires:
+        return clock
+
+    now = datetime.now(tz=get_tz(zone_name))
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    weekday = now.isoweekday() % 7
+    if now.hour < 12:
+        period_ends = now.replace(hour=12, minute=0, second=0, microsecond=0)
+    else:
+        period_ends = midnight + timedelta(days=1)
+    clock = ZoneClock(
+        sunday=midnight - timedelta(days=weekday),
+        last_sunday=midnight - timedelta(days=weekday + 7),
+        period=(weekday * 2) + int(now.hour >= 12),
+        period_ends=period_ends,
+        expires=period_ends.timestamp(),
+    )
+    _clocks[zone_name] = clock
+    return clock
+
 
 @dataclass
 class Record:
+    __slots__ = ("price", "date", "is_am")
+
     price: int
     date: date
     is_am: bool
@@ -33,36 +137,213 @@ class Record:
     def load(cls, data):
         return cls(price=data["price"], date=date.fromisoformat(data["date"]), is_am=data["is_am"])
 
+    def __getstate__(self) -> Tuple[int, int, bool]:
+        return self.price, self.date.toordinal(), self.is_am
+
+    def __setstate__(self, state) -> None:
+        if isinstance(state, dict):
+            # Pickled before Record had __slots__
+            state = state["price"], state["date"].toordinal(), state["is_am"]
+        self.price, ordinal, self.is_am = state
+        self.date = date.fromordinal(ordinal)
+
+
+class Timeline(MutableMapping):
+    """Dict-like view of an island's prices, stored as one unsigned short per period.
+
+    A price of 0 means no price was logged for that period.
+    """
+    __slots__ = ("_prices",)
+
+    def __init__(self, prices: array) -> None:
+        self._prices = prices
+
+    def __getitem__(self, time: TimePeriod) -> int:
+        price = self._prices[time.value]
+        if not price:
+            raise KeyError(time)
+        return price
+
+    def __setitem__(self, time: TimePeriod, price: Optional[int]) -> None:
+        self._prices[time.value] = price or 0
+
+    def __delitem__(self, time: TimePeriod) -> None:
+        if not self._prices[time.value]:
+            raise KeyError(time)
+        self._prices[time.value] = 0
+
+    def __iter__(self) -> Iterator[TimePeriod]:
+        for i, price in enumerate(self._prices):
+            if price:
+                yield TimePeriod(i)
+
+    def __len__(self) -> int:
+        return sum(1 for price in self._prices if price)
+
+    def __repr__(self) -> str:
+        return repr(dict(self.items()))
+
+
+class FinishedWeek(NamedTuple):
+    week: date
+    prices: Tuple[int, ...]
+    pattern: ModelEnum
+
+
+# Packed form: version, previous week, first week?, naive update time?, update timestamp,
+# 14 prices, record price, record date ordinal, record AM?, then the name and time zone
+PACK_VERSION = 1
+PACK_HEADER = struct.Struct("<BB??d14HIi?HB")
+# Largest price that fits in the packed form
+MAX_STORED_PRICE = 2 ** 16 - 1
+
 
-@dataclass
 class WeekData:
-    name: str
+    __slots__ = (
+        "_name", "_prices", "_initial_week", "_previous_week", "updated", "record", "tz_name", "_dirty",
+        "_changes",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        timeline: Mapping[TimePeriod, Optional[int]],
+        _initial_week: bool = False,
+        _previous_week: ModelEnum = ModelEnum.unknown,
+        updated: datetime = datetime(2020, 3, 20, tzinfo=timezone.utc),
+        record: Optional[Record] = None,
+        tz_name: str = "",
+    ) -> None:
+        self._name = name
+        self._prices = array("H", bytes(2 * len(TimePeriod)))
+        self.timeline = timeline
+        self._initial_week = _initial_week
+        self._previous_week = _previous_week
+        self.updated = updated
+        self.record = record if record is not None else Record(0, date.min, False)
+        if self.record.price < 0:
+            logger.warning("Dropping negative record %d for %s", self.record.price, name)
+            self.record = Record(0, date.min, False)
+        self.tz_name = tz_name
+        # Changed since it was last stored; a brand new island has never been stored
+        self._dirty = True
+        # Another process may be creating the same island, so only its prices count as
+        # changes; the name and timezone it starts with are only written if it is new
+        self._changes: Set[str] = {time.name for time in TimePeriod if self._prices[time.value]}
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @name.setter
+    def name(self, name: str) -> None:
+        if name != self._name:
+            self._name = name
+            self._dirty = True
+            self._changes.add("name")
+
+    @property
+    def dirty(self) -> bool:
+        return self._dirty
 
-    timeline: Dict[TimePeriod, int]
-    _initial_week: bool = False
-    _previous_week: ModelEnum = ModelEnum.unknown
+    @property
+    def changes(self) -> FrozenSet[str]:
+        """What has changed since the island was last stored: "name", "timezone", and the
+        name of each period whose price was logged or cleared. A brand new island starts
+        out with just the periods it has a price for.
 
-    updated: datetime = datetime(2020, 3, 20)
-    record: Record = Record(0, date.min, False)
-    tz_name: str = ""
+        Rolling over to a new week is not included, see :meth:`Storage.claim_weeks`.
+        """
+        return frozenset(self._changes)
 
-    def set_price(self, price: int, time: TimePeriod) -> None:
-        if not self.is_current_week:
-            if self.is_last_week:
-                self._previous_week = self.current_pattern
-                self._initial_week = False
-            self.timeline = {}
+    def mark_clean(self) -> None:
+        self._dirty = False
+        self._changes = set()
 
+    @property
+    def timeline(self) -> Timeline:
+        return Timeline(self._prices)
+
+    @timeline.setter
+    def timeline(self, timeline: Mapping[TimePeriod, Optional[int]]) -> None:
+        for i in range(len(self._prices)):
+            self._prices[i] = 0
+        for time, price in timeline.items():
+            if price and not 0 < price <= MAX_STORED_PRICE:
+                # Islands from before prices were packed could hold any number
+                logger.warning("Dropping out of range price %d for %s on %s", price, time.name, self._name)
+                continue
+            self._prices[time.value] = price or 0
+
+    @property
+    def prices(self) -> Tuple[int, ...]:
+        """Prices for all 14 periods, 0 where none was logged."""
+        return tuple(self._prices)
+
+    def set_price(self, price: int, time: TimePeriod) -> bool:
+        """Log a price, returning True if it is a new record for this island."""
+        before = (self.prices, self._initial_week, self._previous_week)
+        self.rollover()
+
+        # If the new price only adds a constraint, this island's solved models can be
+        # narrowed instead of replaying the whole week. Cached models are shared, so it
+        # is a copy that gets narrowed.
+        with _model_cache_lock:
+            models = _model_cache.get(self.fingerprint)
+        if time.value < TimePeriod.Monday_AM.value or self.timeline.get(time, price) != price:
+            models = None
+
+        new_record = False
+        if self._prices[time.value] != price:
+            self._changes.add(time.name)
         if price:
             self.timeline[time] = price
             if price > self.record.price:
                 self.record.set_price(price, time.value % 2 == 1)
+                new_record = True
         elif time in self.timeline:
             del self.timeline[time]
+            models = None
         self.updated = datetime.now(tz=self.timezone)
+        if new_record or before != (self.prices, self._initial_week, self._previous_week):
+            self._dirty = True
+
+        if models is not None and price:
+            models = copy.deepcopy(models)
+            models.fix_price(time, price)
+            metrics.narrows.inc()
+            _cache_models(self.fingerprint, models)
+        return new_record
+
+    def rollover(self) -> Optional[FinishedWeek]:
+        """Start a new week if this island's data is from an earlier one.
+
+        Returns the week that was cleared, if it had any prices.
+        """
+        if self.is_current_week:
+            return None
+
+        finished = None
+        if self.timeline:
+            midnight = self.updated.replace(hour=0, minute=0, second=0, microsecond=0)
+            finished = FinishedWeek(
+                week=(midnight - timedelta(days=midnight.isoweekday() % 7)).date(),
+                prices=self.prices,
+                pattern=self.current_pattern,
+            )
+        if self.is_last_week:
+            self._previous_week = self.current_pattern
+            self._initial_week = False
+        self.timeline = {}
+        self.updated = datetime.now(tz=self.timezone)
+        self._dirty = True
+        return finished
 
     def set_tz(self, zone_name: str) -> bool:
-        if tz.gettz(zone_name):
+        if get_tz(zone_name):
+            if zone_name != self.tz_name:
+                self._dirty = True
+                self._changes.add("timezone")
             self.tz_name = zone_name
             self.updated = self.updated.astimezone(self.timezone)
             return True
@@ -78,15 +359,15 @@ class WeekData:
         if buy_price:
             fixed_points["Sunday_AM"] = buy_price
             last_fixed = "Sunday_PM"
-        for time, price_counts in self.models.histogram().items():
-            if len(price_counts) == 1:
-                fixed_points[time] = list(price_counts.keys())[0]
+        for time, prices in engine.current().price_sets(self.models).items():
+            if len(prices) == 1:
+                fixed_points[time] = prices[0]
                 last_fixed = time
                 continue
 
             # Gather possible prices
             price_set = RangeSet()
-            for price in price_counts.keys():
+            for price in prices:
                 price_set.add(price)
             speculations[time] = str(price_set)
 
@@ -111,7 +392,8 @@ class WeekData:
             price_width = max((len(stat) for stat in speculations.values()))
             yield "```"
             yield f"Time          {'Price'.ljust(price_width)}"
-            for i in range(TimePeriod[last_fixed].value + 1, 14):
+            start = TimePeriod[last_fixed].value + 1 if last_fixed else TimePeriod.Monday_AM.value
+            for i in range(start, 14):
                 time = TimePeriod(i).name
                 stats = speculations[time]
                 yield f"{time:12}  {stats:{price_width}}"
@@ -120,8 +402,8 @@ class WeekData:
             yield f"For more detail, check <{self.prophet_link}>"
 
     def predictions(self) -> str:
-        model_count = Counter(model.model_name for model in self.models.models)
-        patterns = model_count.most_common()
+        prediction_engine = engine.current()
+        patterns = prediction_engine.pattern_counts(self.models)
 
         if len(patterns) == 0:
             return "Uh oh! Your prices don't match any pattern I know about"
@@ -137,19 +419,7 @@ class WeekData:
                 return f"Out of {len(self.models)} possible patterns, {' '.join(pattern_str_list)}."
             return f"Out of {len(self.models)} possible patterns, {', '.join(pattern_str_list)}."
 
-        weights = [
-            [20, 30, 15, 35],
-            [50, 5, 20, 25],
-            [25, 45, 5, 25],
-            [45, 25, 15, 15],
-        ]
-        expected_patterns = [56, 7, 1, 8]
-        expected_weights = weights[self._previous_week.value]
-        probabilities = [0, 0, 0, 0]
-        for pattern_name, count in patterns:
-            model_value = ModelEnum[pattern_name].value
-            probabilities[model_value] = count / expected_patterns[model_value] * expected_weights[model_value]
-
+        probabilities = prediction_engine.probabilities(patterns, self._previous_week)
         pattern_str_list = [
             f"{factor / sum(probabilities) * 100:.1f}% likely to be {ModelEnum(i).name}"
             for i, factor in enumerate(probabilities) if factor > 0
@@ -160,20 +430,13 @@ class WeekData:
         return f"Your pattern is {', '.join(pattern_str_list)}."
 
     @property
-    def models(self) -> MultiModel:
-        base = self.timeline.get(TimePeriod.Sunday_AM)
-        if self._initial_week:
-            models = BumpModels()
-        else:
-            models = MetaModel.blank(base)
+    def fingerprint(self) -> Fingerprint:
+        prices = tuple((i, price) for i, price in enumerate(self._prices) if price)
+        return prices, self._initial_week, self._previous_week
 
-        for time, price in self.timeline.items():
-            if price is None:
-                continue
-            if time.value < TimePeriod.Monday_AM.value:
-                continue
-            models.fix_price(time, price)
-        return models
+    @property
+    def models(self) -> MultiModel:
+        return cached_solve(self.fingerprint)
 
     @property
     def current_pattern(self) -> ModelEnum:
@@ -186,20 +449,16 @@ class WeekData:
 
     @property
     def timezone(self) -> Optional[tzinfo]:
-        return tz.gettz(self.tz_name)
+        return get_tz(self.tz_name)
 
     @property
     def is_current_week(self) -> bool:
-        now = datetime.now(tz=self.timezone)
-        sunday = now.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=now.isoweekday() % 7)
-        return self.updated > sunday
+        return self.updated > zone_clock(self.tz_name).sunday
 
     @property
     def is_last_week(self) -> bool:
-        midnight = datetime.now(tz=self.timezone).replace(hour=0, minute=0, second=0, microsecond=0)
-        sunday = midnight - timedelta(days=midnight.isoweekday() % 7)
-        last_sunday = midnight - timedelta(days=(midnight.isoweekday() % 7) + 7)
-        return sunday > self.updated > last_sunday
+        clock = zone_clock(self.tz_name)
+        return clock.sunday > self.updated > clock.last_sunday
 
     @property
     def has_week_data(self) -> bool:
@@ -214,11 +473,14 @@ class WeekData:
         # We only have one datum, so if Sunday_AM is present, it's just Sunday
         return not self.timeline.get(TimePeriod.Sunday_AM, False)
 
+    @property
+    def period_ends(self) -> datetime:
+        """When the current half-day period ends in this island's timezone."""
+        return zone_clock(self.tz_name).period_ends
+
     @property
     def has_current_period(self) -> bool:
-        now = datetime.now(tz=self.timezone)
-        weekday = now.isoweekday() % 7
-        time_index = (weekday * 2) + int(now.hour >= 12)
+        time_index = zone_clock(self.tz_name).period
 
         # Don't bother looking for Sunday_PM
         if time_index == 1:
@@ -250,6 +512,67 @@ class WeekData:
             "timezone": self.tz_name,
         }
 
+    def pack(self) -> bytes:
+        """Serialize to a compact binary form, as used when pickling."""
+        name = self.name.encode()
+        tz_name = self.tz_name.encode()
+        header = PACK_HEADER.pack(
+            PACK_VERSION,
+            self._previous_week.value,
+            self._initial_week,
+            self.updated.tzinfo is None,
+            self.updated.timestamp(),
+            *self._prices,
+            self.record.price,
+            self.record.date.toordinal(),
+            self.record.is_am,
+            len(name),
+            len(tz_name),
+        )
+        return header + name + tz_name
+
+    @classmethod
+    def unpack(cls, data: bytes) -> WeekData:
+        instance = cls.__new__(cls)
+        instance.__setstate__(data)
+        return instance
+
+    def __getstate__(self) -> bytes:
+        return self.pack()
+
+    def __setstate__(self, state) -> None:
+        if isinstance(state, dict):
+            # Pickled while WeekData was a plain dataclass
+            self.__init__(**state)
+            self.mark_clean()
+            return
+
+        (
+            version, previous_week, initial_week, naive, timestamp, *values
+        ) = PACK_HEADER.unpack_from(state)
+        if version != PACK_VERSION:
+            raise ValueError(f"Unknown WeekData packing version {version}")
+        prices, (record_price, record_date, record_am, name_length, tz_length) = values[:14], values[14:]
+
+        offset = PACK_HEADER.size
+        self._name = state[offset:offset + name_length].decode()
+        self.tz_name = state[offset + name_length:offset + name_length + tz_length].decode()
+        self._prices = array("H", prices)
+        self._initial_week = initial_week
+        self._previous_week = ModelEnum(previous_week)
+        if naive:
+            self.updated = datetime.fromtimestamp(timestamp)
+        else:
+            self.updated = datetime.fromtimestamp(timestamp, tz=self.timezone)
+        self.record = Record(record_price, date.fromordinal(record_date), record_am)
+        self.mark_clean()
+
+    def __repr__(self) -> str:
+        return (
+            f"WeekData(name={self.name!r}, timeline={self.timeline!r}, "
+            f"_previous_week={self._previous_week}, updated={self.updated!r}, tz_name={self.tz_name!r})"
+        )
+
     @classmethod
     def load(cls, data) -> WeekData:
         timeline = {TimePeriod[k]: v for k, v in data["prices"].items()}
@@ -0,0 +1,635 @@
+"""Long-lived handles on the island database.
+
+The database is opened once at startup and kept open. Writes are staged in memory and
+written through on :meth:`Storage.flush`, which the writer calls on an interval and on
+shutdown, so a `log` never pays for opening or syncing the database.
+
+Two backends are available: the original shelf of pickled :class:`WeekData`, and a SQLite
+database with normalized island, price and record tables. :func:`open_backend` picks one
+from the file name. Either way, the best records are kept in a :class:`Leaderboard` that is
+loaded once and updated as prices are logged, so `stats records` never loads an island.
+
+Islands belong to users, not servers, so each guild's members are kept in a separate
+index. Per-guild queries pass those keys to :meth:`Storage.items` and only scan them.
+
+Several bot processes may share a SQLite database, each with its own copy of an island.
+They only write the parts of an island they changed, and a week rollover is claimed in
+the database by whichever process gets there first, so one never undoes another's log.
+"""
+import logging
+import pathlib
+import shelve
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Collection, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from turnips.ttime import TimePeriod
+
+from stonkbot import metrics
+from stonkbot.leaderboard import Leaderboard
+from stonkbot.models import Record, WeekData, zone_clock
+
+SHELVE_FILE = "turnips.db"
+LEADERBOARD_KEY = "__records__"
+GUILDS_KEY = "__guilds__"
+RESERVED_KEYS = {LEADERBOARD_KEY, GUILDS_KEY}
+SQLITE_SUFFIXES = (".sqlite", ".sqlite3")
+FLUSH_INTERVAL = 30.0
+ISLAND_CACHE_SIZE = 10000
+logger = logging.getLogger("stonkbot")
+
+
+def week_floor(now: Optional[datetime] = None) -> datetime:
+    """Return an instant no later than the start of the current week in any timezone."""
+    if now is None:
+        now = datetime.now(tz=timezone.utc)
+    # Local Sunday midnight is never more than a week ago, give or take a DST shift
+    return now - timedelta(days=7, hours=1)
+
+
+class Storage:
+    """Base class for island backends.
+
+    Subclasses only need to know how to load, list and store islands and the leaderboard;
+    caching and staging of writes is handled here. Subclasses open their database before
+    calling ``super().__init__``.
+
+    Recently used islands are kept in memory. Islands that are :meth:`put` are only
+    written back on flush if they are actually dirty. A store opened ``read_only`` is
+    never flushed on close.
+    """
+
+    def __init__(self, path: str, read_only: bool = False) -> None:
+        self.path = path
+        self.read_only = read_only
+        # Readers share the cache from several threads
+        self._cache_lock = threading.Lock()
+        self._islands: "OrderedDict[str, WeekData]" = OrderedDict()
+        # Keys to write on the next flush, in the order they were changed
+        self._pending: Dict[str, None] = {}
+        self._leaderboard_dirty = False
+        self.leaderboard = self._load_leaderboard()
+        # Guild id -> member keys, and the reverse
+        self._guilds: Dict[int, Set[str]] = defaultdict(set)
+        self._memberships: Dict[str, Set[int]] = defaultdict(set)
+        self._new_members: List[Tuple[int, str]] = []
+        for guild, key in self._load_members():
+            self._guilds[guild].add(key)
+            self._memberships[key].add(guild)
+
+    def get(self, key: str) -> Optional[WeekData]:
+        with self._cache_lock:
+            data = self._islands.get(key)
+            if data is not None:
+                self._islands.move_to_end(key)
+        if data is not None:
+            metrics.cache_requests.inc(cache="islands", result="hit")
+            return data
+
+        metrics.cache_requests.inc(cache="islands", result="miss")
+        with metrics.storage_seconds.time(operation="read"):
+            data = self._load(key)
+        if data is not None:
+            with self._cache_lock:
+                data = self._islands.setdefault(key, data)
+                self._evict()
+        return data
+
+    def put(self, key: str, data: WeekData) -> None:
+        with self._cache_lock:
+            self._islands[key] = data
+            self._islands.move_to_end(key)
+            if data.dirty:
+                self._pending[key] = None
+            self._evict()
+
+    def items(
+        self, since: Optional[datetime] = None, keys: Optional[Collection[str]] = None
+    ) -> Iterator[Tuple[str, WeekData]]:
+        """Iterate over stored islands, optionally only those updated after `since` or
+        with one of `keys`."""
+        with self._cache_lock:
+            cached = dict(self._islands)
+            pending = {key: cached[key] for key in self._pending if keys is None or key in keys}
+        for key, data in pending.items():
+            if since is None or data.updated.timestamp() >= since.timestamp():
+                yield key, data
+        for key, data in self._stored_items(since, keys):
+            if key not in pending:
+                yield key, cached.get(key, data)
+
+    def preload(self, since: Optional[datetime] = None) -> int:
+        """Fill the cache with islands updated after `since`, returning how many were loaded."""
+        loaded = 0
+        for key, data in self._stored_items(since):
+            with self._cache_lock:
+                if len(self._islands) >= ISLAND_CACHE_SIZE:
+                    break
+                if key not in self._islands:
+                    self._islands[key] = data
+                    loaded += 1
+        return loaded
+
+    def existing(self, keys: Iterable[str]) -> Set[str]:
+        """Return which of `keys` have an island, whether or not it has been flushed yet."""
+        with self._cache_lock:
+            cached = set(self._islands)
+        return {key for key in keys if key in cached or self._contains(key)}
+
+    def claim_weeks(self, islands: Iterable[Tuple[str, WeekData]]) -> Set[str]:
+        """Record that islands have just rolled over to a new week, returning the keys that
+        this process was first to roll over.
+
+        The others were already rolled over by another process sharing the database; they
+        are dropped from the cache, so :meth:`get` returns that process's copy. Only this
+        process can have rolled over the islands of a backend that can't be shared.
+        """
+        return {key for key, _island in islands}
+
+    def records(self, min_price: int) -> List[Tuple[str, Record]]:
+        """Return (island name, record) pairs at or above `min_price`, best first."""
+        return self.leaderboard.top(min_price)
+
+    def update_record(self, key: str, name: str, record: Record) -> None:
+        if self.leaderboard.update(key, name, record):
+            self._leaderboard_dirty = True
+
+    def rename_record(self, key: str, name: str) -> None:
+        if self.leaderboard.rename(key, name):
+            self._leaderboard_dirty = True
+
+    def add_member(self, guild: int, key: str) -> bool:
+        """Note that an island's owner is in a guild, returning True if that is news."""
+        with self._cache_lock:
+            if key in self._guilds[guild]:
+                return False
+            self._guilds[guild].add(key)
+            self._memberships[key].add(guild)
+            self._new_members.append((guild, key))
+            return True
+
+    def is_member(self, guild: int, key: str) -> bool:
+        return key in self._guilds.get(guild, ())
+
+    def members(self, guild: int) -> Set[str]:
+        with self._cache_lock:
+            return set(self._guilds.get(guild, ()))
+
+    def guilds_of(self, key: str) -> Set[int]:
+        with self._cache_lock:
+            return set(self._memberships.get(key, ()))
+
+    def guilds(self) -> Dict[int, Set[str]]:
+        with self._cache_lock:
+            return {guild: set(keys) for guild, keys in self._guilds.items()}
+
+    def sync(self) -> bool:
+        """Pick up writes made by other processes, returning True if there were any.
+
+        Only backends that can be shared between processes ever return True.
+        """
+        return False
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self._pending) or self._leaderboard_dirty or bool(self._new_members)
+
+    def flush(self) -> None:
+        if not self.dirty:
+            return
+        with self._cache_lock:
+            changed = [(key, self._islands[key]) for key in self._pending]
+            self._pending.clear()
+            members, self._new_members = self._new_members, []
+        logger.info("Flushing %d islands to %s", len(changed), self.path)
+        try:
+            with metrics.storage_seconds.time(operation="write"):
+                self._store(changed)
+                for _key, data in changed:
+                    data.mark_clean()
+                if self._leaderboard_dirty:
+                    self._store_leaderboard(self.leaderboard)
+                    self._leaderboard_dirty = False
+                if members:
+                    self._store_members(members)
+        except Exception:
+            # Keep everything for the next flush, and keep the islands out of eviction
+            with self._cache_lock:
+                self._pending = {**dict.fromkeys(key for key, _data in changed), **self._pending}
+                self._new_members = members + self._new_members
+            raise
+
+    def close(self) -> None:
+        if not self.read_only:
+            self.flush()
+        self._close()
+
+    def _evict(self) -> None:
+        # Islands waiting to be written stay put until the next flush
+        excess = len(self._islands) - ISLAND_CACHE_SIZE
+        for key in list(self._islands):
+            if excess <= 0:
+                break
+            if key not in self._pending:
+                del self._islands[key]
+                excess -= 1
+
+    # Backend specific
+    def _load(self, key: str) -> Optional[WeekData]:
+        raise NotImplementedError
+
+    def _stored_items(
+        self, since: Optional[datetime], keys: Optional[Collection[str]] = None
+    ) -> Iterator[Tuple[str, WeekData]]:
+        raise NotImplementedError
+
+    def _contains(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def _store(self, items: Iterable[Tuple[str, WeekData]]) -> None:
+        raise NotImplementedError
+
+    def _load_leaderboard(self) -> Leaderboard:
+        raise NotImplementedError
+
+    def _store_leaderboard(self, leaderboard: Leaderboard) -> None:
+        raise NotImplementedError
+
+    def _load_members(self) -> Iterable[Tuple[int, str]]:
+        raise NotImplementedError
+
+    def _store_members(self, members: List[Tuple[int, str]]) -> None:
+        raise NotImplementedError
+
+    def _close(self) -> None:
+        raise NotImplementedError
+
+
+class ShelveStorage(Storage):
+    def __init__(self, path: str = SHELVE_FILE, read_only: bool = False) -> None:
+        self._shelf = shelve.open(path, flag="r" if read_only else "c")
+        super().__init__(path, read_only)
+
+    def _load(self, key: str) -> Optional[WeekData]:
+        if key in RESERVED_KEYS:
+            return None
+        return self._shelf.get(key)
+
+    def _stored_items(
+        self, since: Optional[datetime], keys: Optional[Collection[str]] = None
+    ) -> Iterator[Tuple[str, WeekData]]:
+        # Pickled islands have to be loaded to find out when they were updated
+        for key in self._shelf.keys() if keys is None else keys:
+            if key not in RESERVED_KEYS and (keys is None or key in self._shelf):
+                data = self._shelf[key]
+                if since is None or data.updated.timestamp() >= since.timestamp():
+                    yield key, data
+
+    def _contains(self, key: str) -> bool:
+        return key not in RESERVED_KEYS and key in self._shelf
+
+    def _store(self, items: Iterable[Tuple[str, WeekData]]) -> None:
+        for key, data in items:
+            self._shelf[key] = data
+        self._shelf.sync()
+
+    def _load_leaderboard(self) -> Leaderboard:
+        if LEADERBOARD_KEY in self._shelf:
+            return Leaderboard.load(self._shelf[LEADERBOARD_KEY])
+
+        # Shelves from before the leaderboard existed need one full scan to build it
+        leaderboard = Leaderboard()
+        for key, island in self._stored_items(None):
+            leaderboard.update(key, island.name, island.record)
+        self._leaderboard_dirty = True
+        return leaderboard
+
+    def _store_leaderboard(self, leaderboard: Leaderboard) -> None:
+        self._shelf[LEADERBOARD_KEY] = leaderboard.dump()
+        self._shelf.sync()
+
+    def _load_members(self) -> Iterable[Tuple[int, str]]:
+        for guild, keys in self._shelf.get(GUILDS_KEY, {}).items():
+            for key in keys:
+                yield guild, key
+
+    def _store_members(self, members: List[Tuple[int, str]]) -> None:
+        self._shelf[GUILDS_KEY] = {guild: sorted(keys) for guild, keys in self.guilds().items()}
+        self._shelf.sync()
+
+    def _close(self) -> None:
+        self._shelf.close()
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS islands (
+    key TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    updated TEXT NOT NULL,
+    updated_ts REAL NOT NULL,
+    initial_week INTEGER NOT NULL DEFAULT 0,
+    last_week TEXT NOT NULL,
+    timezone TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS islands_updated ON islands (updated_ts);
+
+CREATE TABLE IF NOT EXISTS prices (
+    key TEXT NOT NULL REFERENCES islands (key) ON DELETE CASCADE,
+    period INTEGER NOT NULL,
+    price INTEGER NOT NULL,
+    PRIMARY KEY (key, period)
+);
+
+CREATE TABLE IF NOT EXISTS records (
+    key TEXT PRIMARY KEY REFERENCES islands (key) ON DELETE CASCADE,
+    price INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    is_am INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_price ON records (price DESC);
+
+CREATE TABLE IF NOT EXISTS guild_members (
+    guild INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    PRIMARY KEY (guild, key)
+);
+"""
+# Keep IN (...) lists under SQLite's default limit on bound parameters
+KEY_CHUNK = 500
+
+ISLAND_COLUMNS = (
+    "i.key, i.name, i.updated, i.initial_week, i.last_week, i.timezone, r.price, r.date, r.is_am"
+)
+
+
+class SQLiteStorage(Storage):
+    """Islands in normalized tables, so week and record lookups are index scans.
+
+    This is the backend to use when several bot processes share a database: each one
+    notices the others' commits through ``PRAGMA data_version`` in :meth:`sync`. Islands
+    are written a field and a price at a time, so each process only writes its own changes.
+    """
+
+    def __init__(self, path: str, read_only: bool = False) -> None:
+        # Reads come from the executor's threads, so share one connection behind a lock
+        self._lock = threading.Lock()
+        if read_only:
+            uri = f"{pathlib.Path(path).absolute().as_uri()}?mode=ro"
+            self._conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("PRAGMA foreign_keys=ON")
+            self._conn.executescript(SCHEMA)
+        self._data_version = self._query("PRAGMA data_version")[0][0]
+        # Another process wrote while islands of ours were waiting to be flushed
+        self._reload_pending = False
+        super().__init__(path, read_only)
+
+    def _load(self, key: str) -> Optional[WeekData]:
+        rows = self._query(
+            f"SELECT {ISLAND_COLUMNS} FROM islands i LEFT JOIN records r USING (key) WHERE i.key = ?",
+            (key,),
+        )
+        if not rows:
+            return None
+        prices = {period: price for _, period, price in self._query(
+            "SELECT key, period, price FROM prices WHERE key = ?", (key,)
+        )}
+        return self._to_island(rows[0], prices)
+
+    def _stored_items(
+        self, since: Optional[datetime], keys: Optional[Collection[str]] = None
+    ) -> Iterator[Tuple[str, WeekData]]:
+        conditions, params = [], []
+        if since is not None:
+            conditions.append("i.updated_ts >= ?")
+            params.append(since.timestamp())
+        if keys is None:
+            yield from self._select(conditions, params)
+            return
+
+        keys = sorted(keys)
+        for start in range(0, len(keys), KEY_CHUNK):
+            chunk = keys[start:start + KEY_CHUNK]
+            in_chunk = f"i.key IN ({', '.join('?' * len(chunk))})"
+            yield from self._select([*conditions, in_chunk], [*params, *chunk])
+
+    def _select(self, conditions: List[str], params: List[object]) -> Iterator[Tuple[str, WeekData]]:
+        # Page through the matches in key order, so only KEY_CHUNK islands are in memory
+        # at once and the lock is free between pages
+        after = ""
+        while True:
+            where = " AND ".join([*conditions, "i.key > ?"])
+            rows = self._query(
+                f"SELECT {ISLAND_COLUMNS} FROM islands i LEFT JOIN records r USING (key) "
+                f"WHERE {where} ORDER BY i.key LIMIT {KEY_CHUNK}",
+                (*params, after),
+            )
+            if not rows:
+                return
+            keys = [row[0] for row in rows]
+            prices: Dict[str, Dict[int, int]] = defaultdict(dict)
+            for key, period, price in self._query(
+                f"SELECT key, period, price FROM prices WHERE key IN ({', '.join('?' * len(keys))})", tuple(keys)
+            ):
+                prices[key][period] = price
+
+            for row in rows:
+                yield row[0], self._to_island(row, prices[row[0]])
+            if len(rows) < KEY_CHUNK:
+                return
+            after = keys[-1]
+
+    def _contains(self, key: str) -> bool:
+        return bool(self._query("SELECT 1 FROM islands WHERE key = ?", (key,)))
+
+    def _store(self, items: Iterable[Tuple[str, WeekData]]) -> None:
+        with self._lock, self._conn:
+            for key, data in items:
+                dumped = data.dump()
+                changes = data.changes
+                # Other processes may have changed or even created the island since it was
+                # loaded, so only what changed here is written
+                self._conn.execute(
+                    "INSERT INTO islands (key, name, updated, updated_ts, initial_week, last_week, timezone) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET "
+                    "updated = excluded.updated, updated_ts = excluded.updated_ts "
+                    "WHERE excluded.updated_ts > islands.updated_ts",
+                    (
+                        key, dumped["island_name"], dumped["updated"], data.updated.timestamp(),
+                        int(data._initial_week), dumped["last_week"], dumped["timezone"],
+                    ),
+                )
+                if "name" in changes:
+                    self._conn.execute("UPDATE islands SET name = ? WHERE key = ?", (data.name, key))
+                if "timezone" in changes:
+                    self._conn.execute("UPDATE islands SET timezone = ? WHERE key = ?", (data.tz_name, key))
+                prices = [(time.value, data.prices[time.value]) for time in TimePeriod if time.name in changes]
+                self._conn.executemany(
+                    "INSERT INTO prices (key, period, price) VALUES (?, ?, ?) "
+                    "ON CONFLICT (key, period) DO UPDATE SET price = excluded.price",
+                    [(key, period, price) for period, price in prices if price],
+                )
+                self._conn.executemany(
+                    "DELETE FROM prices WHERE key = ? AND period = ?",
+                    [(key, period) for period, price in prices if not price],
+                )
+                record = dumped["record"]
+                self._conn.execute(
+                    "INSERT INTO records (key, price, date, is_am) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (key) DO UPDATE SET price = excluded.price, date = excluded.date, "
+                    "is_am = excluded.is_am WHERE excluded.price > records.price",
+                    (key, record["price"], record["date"], int(record["is_am"])),
+                )
+
+    def existing(self, keys: Iterable[str]) -> Set[str]:
+        keys = set(keys)
+        with self._cache_lock:
+            # Includes islands that haven't been flushed yet
+            found = keys.intersection(self._islands)
+        keys = sorted(keys - found)
+        for start in range(0, len(keys), KEY_CHUNK):
+            chunk = keys[start:start + KEY_CHUNK]
+            found.update(key for key, in self._query(
+                f"SELECT key FROM islands WHERE key IN ({', '.join('?' * len(chunk))})", tuple(chunk)
+            ))
+        return found
+
+    def claim_weeks(self, islands: Iterable[Tuple[str, WeekData]]) -> Set[str]:
+        # Written straight away, so that the claim is visible to other processes
+        claimed, lost = set(), []
+        with self._lock, self._conn:
+            for key, island in islands:
+                # Still on an earlier week in the database, unless someone else rolled it over
+                cursor = self._conn.execute(
+                    "UPDATE islands SET updated = ?, updated_ts = ?, initial_week = ?, last_week = ? "
+                    "WHERE key = ? AND updated_ts < ?",
+                    (
+                        island.updated.isoformat(), island.updated.timestamp(), int(island._initial_week),
+                        island._previous_week.name, key, zone_clock(island.tz_name).sunday.timestamp(),
+                    ),
+                )
+                if cursor.rowcount:
+                    self._conn.execute("DELETE FROM prices WHERE key = ?", (key,))
+                    claimed.add(key)
+                elif self._conn.execute("SELECT 1 FROM islands WHERE key = ?", (key,)).fetchone():
+                    lost.append(key)
+                else:
+                    # Never stored, so nobody else knows about it
+                    claimed.add(key)
+        if lost:
+            with self._cache_lock:
+                for key in lost:
+                    self._islands.pop(key, None)
+                    self._pending.pop(key, None)
+        return claimed
+
+    def _load_leaderboard(self) -> Leaderboard:
+        leaderboard = Leaderboard()
+        for key, name, price, day, is_am in self._query(
+            "SELECT r.key, i.name, r.price, r.date, r.is_am FROM records r JOIN islands i USING (key) "
+            "ORDER BY r.price DESC LIMIT ?",
+            (leaderboard.size,),
+        ):
+            leaderboard.update(key, name, Record.load({"price": price, "date": day, "is_am": bool(is_am)}))
+        return leaderboard
+
+    def _store_leaderboard(self, leaderboard: Leaderboard) -> None:
+        # The records table is the index, and it is written along with each island
+        pass
+
+    def _load_members(self) -> Iterable[Tuple[int, str]]:
+        return self._query("SELECT guild, key FROM guild_members")
+
+    def _store_members(self, members: List[Tuple[int, str]]) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR IGNORE INTO guild_members (guild, key) VALUES (?, ?)", members)
+
+    def sync(self) -> bool:
+        version = self._query("PRAGMA data_version")[0][0]
+        if version == self._data_version:
+            return False
+
+        self._data_version = version
+        leaderboard = self._load_leaderboard()
+        with self._cache_lock:
+            for key in [key for key in self._islands if key not in self._pending]:
+                del self._islands[key]
+            # Our copies of these are missing the other process's changes
+            self._reload_pending = self._reload_pending or bool(self._pending)
+            for key in self._pending:
+                island = self._islands[key]
+                leaderboard.update(key, island.name, island.record)
+            for guild, key in self._load_members():
+                self._guilds[guild].add(key)
+                self._memberships[key].add(guild)
+        self.leaderboard = leaderboard
+        return True
+
+    def flush(self) -> None:
+        super().flush()
+        if self._reload_pending:
+            # Have the next sync drop the islands just written, so they are read back with
+            # every process's changes
+            self._reload_pending = False
+            self._data_version = -1
+
+    def _close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _query(self, sql: str, params: tuple = ()) -> List[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    @staticmethod
+    def _to_island(row: tuple, prices: Dict[int, int]) -> WeekData:
+        _key, name, updated, initial_week, last_week, tz_name, price, day, is_am = row
+        island = WeekData.load({
+            "island_name": name,
+            "updated": updated,
+            "prices": {TimePeriod(period).name: value for period, value in prices.items()},
+            "last_week": last_week,
+            "record": {"price": price or 0, "date": day or "0001-01-01", "is_am": bool(is_am)},
+            "timezone": tz_name,
+        })
+        island._initial_week = bool(initial_week)
+        island.mark_clean()
+        return island
+
+
+def open_backend(path: str, read_only: bool = False) -> Storage:
+    with metrics.storage_seconds.time(operation="open"):
+        if path.endswith(SQLITE_SUFFIXES):
+            return SQLiteStorage(path, read_only)
+        return ShelveStorage(path, read_only)
+
+
+def migrate(source: Storage, destination: Storage) -> int:
+    """Copy every island from one backend to another through WeekData.dump/load."""
+    count = 0
+    for key, island in source.items():
+        copy = WeekData.load(island.dump())
+        copy._initial_week = island._initial_week
+        destination.put(key, copy)
+        destination.update_record(key, copy.name, copy.record)
+        count += 1
+    for guild, keys in source.guilds().items():
+        for key in keys:
+            destination.add_member(guild, key)
+    destination.flush()
+    return count
+
+
+if __name__ == "__main__":
+    # python -m stonkbot.storage turnips.db turnips.sqlite
+    # The source is only read, so building its leaderboard or index doesn't change it
+    source, destination = open_backend(sys.argv[1], read_only=True), open_backend(sys.argv[2])
+    print(f"Migrated {migrate(source, destination)} islands")
+    source.close()
+    destination.close()
@@ -1,4 +1,7 @@
+import threading
+from contextlib import contextmanager
 from datetime import datetime
+from typing import Iterable, Iterator, List
 
 from turnips.ttime import TimePeriod
 
@@ -21,3 +24,78 @@ def datetime_to_timeperiod(timestamp: datetime) -> TimePeriod:
             "use `!turnip log {price} [time period]` instead."
         )
     return TimePeriod(weekday * 2 + (0 if timestamp.hour < 12 else 1))
+
+
+# Discord rejects messages longer than this
+MESSAGE_LIMIT = 2000
+CODE_FENCE = "```"
+
+
+def paginate(lines: Iterable[str], limit: int = MESSAGE_LIMIT) -> Iterator[str]:
+    """Join lines into messages of at most `limit` characters.
+
+    Lines are consumed as they come. A code block split across messages is closed at the
+    end of one and reopened at the start of the next.
+    """
+    page: List[str] = []
+    # Length of the page joined with newlines
+    size = -1
+    in_code = False
+    for line in lines:
+        # Leave room to close an open code block
+        reserve = len(CODE_FENCE) + 1 if in_code or line.startswith(CODE_FENCE) else 0
+        if page and size + 1 + len(line) + reserve > limit:
+            if in_code:
+                page.append(CODE_FENCE)
+            yield "\n".join(page)
+            page = [CODE_FENCE] if in_code else []
+            size = len(CODE_FENCE) if in_code else -1
+        line = line[:limit - reserve - size - 1]
+        page.append(line)
+        size += 1 + len(line)
+        if line.startswith(CODE_FENCE):
+            in_code = not in_code
+    if page:
+        yield "\n".join(page)
+
+
+class ReadWriteLock:
+    """Allow any number of concurrent readers, or a single writer.
+
+    Waiting writers block new readers so a stream of aggregate queries can't starve a log.
+    """
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        with self._cond:
+            while self._writing or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writing or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()